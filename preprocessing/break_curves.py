@@ -0,0 +1,280 @@
+import numpy as np
+import pandas as pd
+import hashlib
+import pickle
+import json
+import os
+
+#Fields with one value per goniometer measurement, and the files they are saved to
+measurement_fields = {'Angle':'angle',
+                      'Number of Vertices':'num_vert',
+                      'Radius':'radius',
+                      'Fit':'fit',
+                      'Segmentation Parameter':'segparam'}
+
+#Fields with one value per point along the ordered curve (measurements plus the two end points)
+point_fields = {'x':'x',
+                'y':'y',
+                'z':'z'}
+
+def save_break_curves(angledata, directory='break_curve_data'):
+    """Save Break Curves
+    ========
+
+    Saves the break curve dictionary in a columnar format, with one flat array per field
+    and offsets arrays giving where each break starts. All arrays are saved as .npy files
+    in the given directory.
+
+    Parameters
+    ----------
+    angledata : python dictionary
+        Break curve data, indexed by specimen and break number, as generated by process_VG_data.py.
+    directory : string (optional), default = 'break_curve_data'
+        Directory to save the .npy files in.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    specimens = [s for s in angledata for b in angledata[s]]
+    break_nums = [b for s in angledata for b in angledata[s]]
+    curves = [angledata[s][b] for s in angledata for b in angledata[s]]
+
+    counts = np.array([c['Number of Measurements'] for c in curves], dtype=int)
+    offsets = np.hstack(([0],np.cumsum(counts)))
+    point_offsets = offsets + 2*np.arange(len(offsets))
+
+    np.save(os.path.join(directory,'specimen.npy'), np.array(specimens, dtype=str))
+    np.save(os.path.join(directory,'break_num.npy'), np.array(break_nums, dtype=int))
+    np.save(os.path.join(directory,'offsets.npy'), offsets)
+    np.save(os.path.join(directory,'point_offsets.npy'), point_offsets)
+
+    for field,fname in {**measurement_fields, **point_fields}.items():
+        np.save(os.path.join(directory,fname+'.npy'), np.hstack([c[field] for c in curves]))
+
+    save_break_counts(np.array(specimens, dtype=str), directory)
+
+def specimen_key(directory='break_curve_data', content_hash=False):
+    """Specimen Key
+    ========
+
+    Key of the specimen index (specimen.npy) of the store, used to check that break_counts.csv
+    is in sync with it. Same as file_key in mesh_stats.py.
+
+    Parameters
+    ----------
+    directory : string (optional), default = 'break_curve_data'
+        Directory of the break curve store.
+    content_hash : bool (optional), default = False
+        Whether to use a hash of the file contents instead of the size and modification time.
+
+    Returns
+    -------
+    key : list
+        Size and modification time of specimen.npy, or its SHA1 hash.
+    """
+    fname = os.path.join(directory,'specimen.npy')
+    if content_hash:
+        with open(fname, 'rb') as f:
+            return ['sha1', hashlib.sha1(f.read()).hexdigest()]
+    else:
+        s = os.stat(fname)
+        return [s.st_size, s.st_mtime_ns]
+
+def save_break_counts(specimens, directory='break_curve_data', content_hash=False):
+    """Save Break Counts
+    ========
+
+    Saves the number of breaks of each specimen to break_counts.csv in the store directory,
+    a small index that can be read without touching any curve data. The key of specimen.npy 
+    (see specimen_key) is saved next to it in break_counts_source.json.
+
+    Parameters
+    ----------
+    specimens : numpy array (string)
+        Specimen of each break.
+    directory : string (optional), default = 'break_curve_data'
+        Directory of the break curve store.
+    content_hash : bool (optional), default = False
+        Whether the saved key is a hash of specimen.npy instead of its size and modification time.
+    """
+    specimen_list, counts = np.unique(specimens, return_counts=True)
+    df = pd.DataFrame({'Specimen':specimen_list, 'NumBreaks':counts})
+    df.to_csv(os.path.join(directory,'break_counts.csv'), index=False)
+    with open(os.path.join(directory,'break_counts_source.json'), 'w') as f:
+        json.dump(specimen_key(directory, content_hash), f)
+
+def load_break_counts(directory='break_curve_data', content_hash=False):
+    """Load Break Counts
+    ========
+
+    Loads the number of breaks of each specimen saved by save_break_counts. If the file is missing,
+    or specimen.npy changed since it was saved, it is created from the specimen index of the store.
+
+    Parameters
+    ----------
+    directory : string (optional), default = 'break_curve_data'
+        Directory of the break curve store.
+    content_hash : bool (optional), default = False
+        Whether to detect changes of specimen.npy by a hash of its contents, instead of its size and 
+        modification time. Reads the whole file on every call.
+
+    Returns
+    -------
+    counts : pandas series
+        Number of breaks, indexed by specimen.
+    """
+    fname = os.path.join(directory,'break_counts.csv')
+    source = os.path.join(directory,'break_counts_source.json')
+    stale = True
+    if os.path.isfile(fname) and os.path.isfile(source):
+        with open(source) as f:
+            stale = json.load(f) != specimen_key(directory, content_hash)
+    if stale:
+        save_break_counts(np.load(os.path.join(directory,'specimen.npy')), directory, content_hash)
+    return pd.read_csv(fname, index_col='Specimen')['NumBreaks']
+
+def load_break_curves(directory='break_curve_data', fields=None, mmap_mode='r'):
+    """Load Break Curves
+    ========
+
+    Loads break curve data saved by save_break_curves. The arrays are memory mapped by default,
+    so loading is near instant and only the parts of a field that are used are read from disk.
+    The data for break j of field f is store[f][store['offsets'][j]:store['offsets'][j+1]]
+    for measurement fields, and uses store['point_offsets'] instead for x, y and z.
+
+    Parameters
+    ----------
+    directory : string (optional), default = 'break_curve_data'
+        Directory the .npy files were saved in.
+    fields : list (optional)
+        Fields to load. Loads all if not provided.
+    mmap_mode : string (optional), default = 'r'
+        Memory map mode passed to np.load. Use None to read the arrays into memory.
+
+    Returns
+    -------
+    store : python dictionary
+        Contains the arrays 'Specimen' and 'BreakNo' (one entry per break), 'offsets',
+        'point_offsets', and one flat array for each field.
+    """
+
+    all_fields = {**measurement_fields, **point_fields}
+    if fields is None:
+        fields = list(all_fields.keys())
+
+    load = lambda fname: np.load(os.path.join(directory,fname+'.npy'), mmap_mode=mmap_mode)
+    store = {'Specimen':load('specimen'),
+             'BreakNo':load('break_num'),
+             'offsets':load('offsets'),
+             'point_offsets':load('point_offsets')}
+    for field in fields:
+        store[field] = load(all_fields[field])
+
+    return store
+
+def break_index(store):
+    """Break Index
+    ========
+
+    Dictionary mapping (specimen, break number) to the position of the break in the store.
+
+    Parameters
+    ----------
+    store : python dictionary
+        Break curve data from load_break_curves.
+
+    Returns
+    -------
+    index : python dictionary
+        Position of each break, indexed by (specimen, break number).
+    """
+    return {(s,b):j for j,(s,b) in enumerate(zip(store['Specimen'].tolist(),store['BreakNo'].tolist()))}
+
+def break_curve(store, j):
+    """Break Curve
+    ========
+
+    Returns the data of a single break as a dictionary of array slices.
+
+    Parameters
+    ----------
+    store : python dictionary
+        Break curve data from load_break_curves.
+    j : int
+        Position of the break in the store (see break_index).
+
+    Returns
+    -------
+    curve : python dictionary
+        Break curve data in the same format as break_curve_data.pkl.
+    """
+    i0, i1 = store['offsets'][j], store['offsets'][j+1]
+    p0, p1 = store['point_offsets'][j], store['point_offsets'][j+1]
+    curve = {'Number of Measurements':int(i1-i0)}
+    for field in measurement_fields:
+        if field in store:
+            curve[field] = np.asarray(store[field][i0:i1])
+    for field in point_fields:
+        if field in store:
+            curve[field] = np.asarray(store[field][p0:p1])
+    return curve
+
+def principal_directions(X, offsets):
+    """Principal Directions
+    ========
+
+    Computes the principal direction (first PCA vector) of every curve in a ragged array of points
+    at once. The 3x3 covariance matrices of all curves are formed with segmented sums and
+    diagonalized with a single stacked eigh call.
+
+    Parameters
+    ----------
+    X : numpy array
+        Points of all curves (n x 3), for example the x, y and z fields of the store stacked as columns.
+    offsets : numpy array (int)
+        Start of each curve, followed by the total number of points (e.g., store['point_offsets']).
+
+    Returns
+    -------
+    dirs : numpy array
+        Unit principal direction of each curve (num_curves x 3). The sign is arbitrary.
+    """
+    starts, counts = offsets[:-1], np.diff(offsets)
+    ids = np.repeat(np.arange(len(counts)), counts)
+    mean = np.add.reduceat(X, starts, axis=0)/counts[:,None]
+    Y = X - mean[ids]
+    cov = np.add.reduceat(Y[:,:,None]*Y[:,None,:], starts, axis=0)
+    _, vecs = np.linalg.eigh(cov)
+    return vecs[:,:,-1]
+
+def curve_dict(store):
+    """Curve Dictionary
+    ========
+
+    Converts the columnar break curve data back to the nested dictionary format
+    of break_curve_data.pkl, for older code.
+
+    Parameters
+    ----------
+    store : python dictionary
+        Break curve data from load_break_curves.
+
+    Returns
+    -------
+    angledata : python dictionary
+        Break curve data, indexed by specimen and break number.
+    """
+    angledata = {}
+    for j,(specimen,break_num) in enumerate(zip(store['Specimen'].tolist(),store['BreakNo'])):
+        if specimen not in angledata:
+            angledata[specimen] = {}
+        angledata[specimen][break_num] = break_curve(store, j)
+    return angledata
+
+
+if __name__ == '__main__':
+
+    #Convert break_curve_data.pkl to the columnar format
+    with open('break_curve_data.pkl', 'rb') as f:
+        angledata = pickle.load(f)
+    save_break_curves(angledata)
@@ -1,68 +1,130 @@
 import numpy as np
-import pickle
-import matplotlib.pyplot as plt
 import pandas as pd
-from scipy import spatial
-import amaazetools.trimesh as tm
-import sys
+from break_curves import load_break_curves, principal_directions
 
-def arc_length(x,y,z):
-    """Arc Length
+def segment_ids(offsets):
+    """Segment IDs
     ========
 
-    Computes the arclength of a path.
-    
+    Index of the segment (break) that each entry of a ragged array belongs to.
+
     Parameters
     ----------
-    x : numpy array
-        x-coordinates along path.
-    y : numpy array
-        y-coordinates along path.
-    z : numpy array
-        z-coordinates along path.
+    offsets : numpy array (int)
+        Start of each segment, followed by the total length.
 
     Returns
     -------
-    length : float
-        Arclength of path.
+    ids : numpy array (int)
+        Segment index of each entry.
     """
-    v = np.vstack((x,y,z))
-    length = 0
-    for i in range(len(x)-1):
-        length += np.linalg.norm(v[:,i+1] - v[:,i])
-    return length
-
-def arc_angle(x,y,z,principal_dir):
-    """Arc Angle
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+def segment_stats(values, offsets):
+    """Segment Statistics
     ========
 
-    Computes the arcangle of a break relative to principal axis of fragment.
-    
+    Computes summary statistics of every segment of a ragged array at once.
+    All segments must be nonempty.
+
     Parameters
     ----------
-    x : numpy array
-        x-coordinates along break.
-    y : numpy array
-        y-coordinates along break.
-    y : numpy array
-        y-coordinates along break.
-    principal_dir : numpy array
-        Principal axis of the fragment.
+    values : numpy array (float)
+        Flat array of values.
+    offsets : numpy array (int)
+        Start of each segment, followed by the total length.
 
     Returns
     -------
-    angle : float
-        Arcangle
+    stats : python dictionary
+        Arrays 'Count', 'Mean', 'Median', 'STD', 'Max', 'Min' and 'Range', with one entry per segment.
     """
-    v = np.vstack((x,y,z)).T
-    _, vecs = tm.pca(v)
-    break_dir = vecs[:,0]
-    angle = np.arccos(np.abs(np.dot(principal_dir,break_dir)))*180/np.pi
-    return angle
+    values = np.asarray(values, dtype=float)
+    starts, counts = offsets[:-1], np.diff(offsets)
+    ids = segment_ids(offsets)
+
+    mean = np.add.reduceat(values, starts)/counts
+    std = np.sqrt(np.add.reduceat((values - mean[ids])**2, starts)/counts)
+    max_val = np.maximum.reduceat(values, starts)
+    min_val = np.minimum.reduceat(values, starts)
+
+    #Median from values sorted within each segment
+    sorted_values = values[np.lexsort((values, ids))]
+    median = (sorted_values[starts + (counts-1)//2] + sorted_values[starts + counts//2])/2
+
+    return {'Count':counts, 'Mean':mean, 'Median':median, 'STD':std, 'Max':max_val, 'Min':min_val, 'Range':max_val - min_val}
 
-#Load angle data dictionary
-with open('break_curve_data.pkl', 'rb') as f:
-    angledata = pickle.load(f)
+def arc_lengths(X, offsets):
+    """Arc Lengths
+    ========
+
+    Computes the arclength of every path in a ragged array of points.
+
+    Parameters
+    ----------
+    X : numpy array
+        Points of all paths (n x 3).
+    offsets : numpy array (int)
+        Start of each path, followed by the total number of points.
+
+    Returns
+    -------
+    length : numpy array
+        Arclength of each path.
+    """
+    d = np.zeros(len(X))
+    d[:-1] = np.linalg.norm(X[1:] - X[:-1], axis=1)
+    d[offsets[1:]-1] = 0  #Remove steps from the end of one path to the start of the next
+    return np.add.reduceat(d, offsets[:-1])
+
+def euclidean_lengths(X, offsets):
+    """Euclidean Lengths
+    ========
+
+    Computes the distance between the end points of every path in a ragged array of points.
+
+    Parameters
+    ----------
+    X : numpy array
+        Points of all paths (n x 3).
+    offsets : numpy array (int)
+        Start of each path, followed by the total number of points.
+
+    Returns
+    -------
+    length : numpy array
+        Euclidean length of each path.
+    """
+    return np.linalg.norm(X[offsets[:-1]] - X[offsets[1:]-1], axis=1)
+
+def arc_angles(X, offsets, principal_dirs):
+    """Arc Angles
+    ========
+
+    Computes the arcangle of every break relative to the principal axis of its fragment.
+
+    Parameters
+    ----------
+    X : numpy array
+        Points of all breaks (n x 3).
+    offsets : numpy array (int)
+        Start of each break, followed by the total number of points.
+    principal_dirs : numpy array
+        Principal axis of the fragment of each break (num_breaks x 3).
+
+    Returns
+    -------
+    angle : numpy array
+        Arcangle of each break, in degrees.
+    """
+    break_dirs = principal_directions(X, offsets)
+    dots = np.clip(np.abs(np.sum(principal_dirs*break_dirs, axis=1)), 0, 1)
+    return np.arccos(dots)*180/np.pi
+
+#Load break curve data
+store = load_break_curves(fields=['Angle','x','y','z'])
+offsets, point_offsets = store['offsets'], store['point_offsets']
+X = np.stack((store['x'], store['y'], store['z']), axis=1)
 
 #Open mesh_stats data frame
 mesh_stats_df = pd.read_csv('mesh_stats.csv', encoding = 'cp1252')
@@ -75,66 +137,24 @@ frag_df = pd.read_csv('frag_data.csv')
 #Frag level fields
 frag_fields = ['Species','Common','SzCl','SizeRangeLb','SizeRangeKg','SkelPort','LPort','Element','Side','ActorTaxon','Effector','trab','Surface Area','Volume','Bounding Box Dim1','Bounding Box Dim2','Bounding Box Dim3']
 
-sys.stdout = open('break_level_ml.csv', 'w')
-print('Specimen,BreakNo,Count,Mean,Median,STD,Max,Min,Range,ArcLength,EuclideanLength,ArcAngle',end='')
-for field in manual_fields:
-    print(','+field,end='')
-for field in frag_fields:
-    print(','+field,end='')
-print('')
-#Loop over the meshes
-for mesh_name in angledata:
-    
-    mesh_stats = mesh_stats_df.loc[mesh_stats_df['Specimen'] == mesh_name]
-    manual_data = manual_data_df.loc[manual_data_df['Specimen'] == mesh_name]
-    frag_data = frag_df.loc[frag_df['Specimen'] == mesh_name]
-
-    for break_num in angledata[mesh_name]:
-        print(mesh_name[:10],end=',')
-        print(break_num,end=',')
-        angles = angledata[mesh_name][break_num]['Angle']
-        count = len(angles)
-        mean = np.mean(angles)
-        median = np.median(angles)
-        std = np.std(angles)
-        max_angle = np.max(angles)
-        min_angle = np.min(angles)
-        angle_range = max_angle - min_angle
-
-        #Get x,y,z coordinates along arc
-        x = angledata[mesh_name][break_num]['x']
-        y = angledata[mesh_name][break_num]['y']
-        z = angledata[mesh_name][break_num]['z']
-
-        #Arc length
-        al = arc_length(x,y,z)
-
-        #Euclidean length
-        el = np.sqrt( (x[0] - x[-1])**2 + (y[0] - y[-1])**2 + (z[0] - z[-1])**2)
-
-        #Arc angle
-        principle_dir = np.array([mesh_stats['nv a 1'].iloc[0], mesh_stats['nv a 2'].iloc[0], mesh_stats['nv a 3'].iloc[0]])
-        aa = arc_angle(x,y,z,principle_dir)
-
-        #Must go in same order as above
-        print(count,end=',')
-        print(mean,end=',')
-        print(median,end=',')
-        print(std,end=',')
-        print(max_angle,end=',')
-        print(min_angle,end=',')
-        print(angle_range,end=',')
-        print(al,end=',')
-        print(el,end=',')
-        print(aa,end='')
-
-        for field in manual_fields:
-            print(','+str(manual_data[field].iloc[0]),end='')
-
-        for field in frag_fields:
-            print(','+str(frag_data[field].iloc[0]),end='')
-
-        print('')
-
-sys.stdout.close()
- 
+#One row per break
+df = pd.DataFrame({'Specimen':store['Specimen'].astype(str), 'BreakNo':store['BreakNo']})
+
+#Summary statistics of angles
+for field,vals in segment_stats(store['Angle'], offsets).items():
+    df[field] = vals
+
+#Arc length and Euclidean length
+df['ArcLength'] = arc_lengths(X, point_offsets)
+df['EuclideanLength'] = euclidean_lengths(X, point_offsets)
+
+#Arc angle relative to principal axis of the fragment
+principal_dirs = mesh_stats_df.drop_duplicates('Specimen').set_index('Specimen').loc[df['Specimen'], ['nv a 1','nv a 2','nv a 3']].values
+df['ArcAngle'] = arc_angles(X, point_offsets, principal_dirs)
+
+#Join manual and fragment level data by specimen (first row for each specimen, as before)
+manual_data = manual_data_df.drop_duplicates('Specimen').set_index('Specimen')[manual_fields]
+frag_data = frag_df.drop_duplicates('Specimen').set_index('Specimen')[frag_fields]
+df = df.join(manual_data, on='Specimen').join(frag_data, on='Specimen')
+
+df.to_csv('break_level_ml.csv', index=False, na_rep='nan')
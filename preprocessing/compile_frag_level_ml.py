@@ -1,6 +1,6 @@
 import pandas as pd
 import numpy as np
-import sys
+import os
 
 #Fields to compute summary statistics of
 sum_stats_fields = ['Mean','Median','STD','Max','Min','Range','ArcLength','EuclideanLength','ArcAngle']
@@ -11,115 +11,110 @@ counts_fields =  ['interior_edge','Interrupted','ridge_notch','interior_notch']
 #Frag level fields
 frag_fields = ['Species','Common','SzCl','SizeRangeLb','SizeRangeKg','SkelPort','LPort','Element','Side','ActorTaxon','Effector','trab','Surface Area','Volume','Bounding Box Dim1','Bounding Box Dim2','Bounding Box Dim3']
 
-#All fields at frag level
-all_fields = counts_fields + sum_stats_fields 
-
-#Read CSV file
-df = pd.read_csv('break_level_ml.csv')
-
-#Initialize frag level dictionary
-frag_data = {}
-
-#Keep track of possible categorical values
-cat_values = {}
-for field in counts_fields:
-    cat_values[field]=[]
-
-#Build dictionary at fragment level
-for i in range(len(df)):
-    
-    Specimen = df['Specimen'][i]
-
-    #Add specimen to dictionary if not already present
-    if Specimen not in frag_data.keys():
-        frag_data[Specimen] = {'Break Count':0}  #Start with 0 break count
-        for field in all_fields:
-            frag_data[Specimen][field] = []  #Initialize with empty list
-
-    #Increment break count
-    frag_data[Specimen]['Break Count'] += 1
-
-    #Append all counts fields to list and update cat_values
-    for field in counts_fields:
-        s = str(df[field][i])
-        frag_data[Specimen][field] += [s]
-        if s not in cat_values[field]:
-            cat_values[field] += [s]
-
-    #Append all summary stats fields to list
-    for field in sum_stats_fields:
-        frag_data[Specimen][field] += [df[field][i]]
-
-
-#Loop over fragments and compute summary statistics, counts, and copy data
-frag_sum_data = {}
-for Specimen in frag_data:
-
-    frag_sum_data[Specimen]={}
-
-    #Beak count
-    frag_sum_data[Specimen]['Break Count'] = frag_data[Specimen]['Break Count']
+#Only recompute fragments whose breaks or fragment data changed since the last run
+incremental = False
+
+#Fingerprints of the input rows of each fragment, used by the incremental mode
+hash_file = 'frag_level_ml_hashes.csv'
+
+def specimen_hashes(df, frag_df):
+    """Specimen Hashes
+    ========
+
+    Fingerprints the break level rows and fragment level row of every specimen,
+    so that fragments whose input data changed can be detected.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Break level data.
+    frag_df : pandas dataframe
+        Fragment level data, indexed by specimen.
+
+    Returns
+    -------
+    hashes : pandas series
+        Hash of the input data of each specimen, indexed by specimen.
+    """
+    cols = ['Specimen'] + counts_fields + sum_stats_fields
+    row_hash = pd.util.hash_pandas_object(df[cols], index=False).values
+    #Order independent within a specimen, but sensitive to the break number
+    row_hash = row_hash*np.uint64(2654435761) ^ pd.util.hash_pandas_object(df['BreakNo'], index=False).values
+    hashes = pd.Series(row_hash, index=df['Specimen'].values).groupby(level=0, sort=False).sum()
+    frag_hash = pd.Series(pd.util.hash_pandas_object(frag_df[frag_fields], index=False).values, index=frag_df.index)
+    return hashes + frag_hash.reindex(hashes.index, fill_value=0).values
+
+def frag_summary(df, frag_df, cat_values):
+    """Fragment Summary
+    ========
+
+    Computes the fragment level data from the break level data in one grouped pass: the break count,
+    counts of each categorical value, and summary statistics of each numerical field. The fragment
+    level fields are then joined from frag_df.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Break level data.
+    frag_df : pandas dataframe
+        Fragment level data, indexed by specimen.
+    cat_values : python dictionary
+        List of possible values of each counts field.
+
+    Returns
+    -------
+    frag_sum_df : pandas dataframe
+        Fragment level data, with one row per specimen in order of first appearance.
+    """
+    grouped = df.groupby('Specimen', sort=False)
+    specimens = pd.Index(df['Specimen'].unique(), name='Specimen')
+    frag_sum_df = pd.DataFrame({'Break Count':grouped.size()}).reindex(specimens)
 
     #Counting fields
     for field in counts_fields:
-        data = np.array(frag_data[Specimen][field])
-        for value in cat_values[field]:
-            count = np.sum(data == value)
-            frag_sum_data[Specimen][field+'_'+value] = count
+        counts = pd.crosstab(df['Specimen'], df[field].astype(str))
+        counts = counts.reindex(index=specimens, columns=cat_values[field], fill_value=0)
+        counts.columns = [field+'_'+value for value in cat_values[field]]
+        frag_sum_df = frag_sum_df.join(counts)
 
     #Summary statistics fields
+    stats = grouped[sum_stats_fields]
+    stats = {'min':stats.min(), 'max':stats.max(), 'mean':stats.mean(), 'median':stats.median(), 'std':stats.std(ddof=0)}
     for field in sum_stats_fields:
-        data = np.array(frag_data[Specimen][field])
-        frag_sum_data[Specimen][field+'_min'] = np.min(data)
-        frag_sum_data[Specimen][field+'_max'] = np.max(data)
-        frag_sum_data[Specimen][field+'_mean'] = np.mean(data)
-        frag_sum_data[Specimen][field+'_median'] = np.median(data)
-        frag_sum_data[Specimen][field+'_std'] = np.std(data)
-
-
-#Copy over fragment level data now
-df = pd.read_csv('frag_data.csv')
-for Specimen in frag_sum_data:
-    frag_info = df.loc[df['Specimen'] == Specimen]
-    for field in frag_fields:
-        frag_sum_data[Specimen][field] = frag_info[field].iloc[0]
-
-#Print out to CSV file
-#Print header (column titles) of CSV file
-sys.stdout = open('frag_level_ml.csv', 'w')
-specimen = list(frag_sum_data.keys())[0]
-columns = ['Specimen'] + list(frag_sum_data[specimen].keys())
-print(','.join(columns))
-
-#Print all data to CSV file
-for Specimen in frag_sum_data:
-    print(Specimen,end='')
-    for field in frag_sum_data[Specimen]:
-        print(',',end='')
-        print(frag_sum_data[Specimen][field],end='')
-    print('') 
-
-sys.stdout.close()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        for stat in stats:
+            frag_sum_df[field+'_'+stat] = stats[stat][field].reindex(specimens)
+
+    #Copy over fragment level data
+    frag_sum_df = frag_sum_df.join(frag_df[frag_fields])
+
+    return frag_sum_df.reset_index()
+
+#Read CSV files
+df = pd.read_csv('break_level_ml.csv', float_precision='round_trip')
+frag_df = pd.read_csv('frag_data.csv', float_precision='round_trip').drop_duplicates('Specimen').set_index('Specimen')
+
+#Possible categorical values, in order of first appearance
+cat_values = {field:list(df[field].astype(str).unique()) for field in counts_fields}
+
+hashes = specimen_hashes(df, frag_df)
+if incremental and os.path.isfile('frag_level_ml.csv') and os.path.isfile(hash_file):
+    old_df = pd.read_csv('frag_level_ml.csv', float_precision='round_trip').set_index('Specimen')
+    old_hashes = pd.read_csv(hash_file, index_col='Specimen')['Hash'].astype(np.uint64)
+    changed = hashes.index[hashes.values != old_hashes.reindex(hashes.index, fill_value=0).values]
+
+    #Recompute the changed fragments, and keep the others (in the current order)
+    columns = frag_summary(df.iloc[:1], frag_df, cat_values).columns[1:]
+    new_df = frag_summary(df[df['Specimen'].isin(changed)], frag_df, cat_values).set_index('Specimen')
+    frag_sum_df = pd.concat((old_df.drop(changed, errors='ignore'), new_df)).reindex(hashes.index)
+
+    #Count columns of categorical values not seen before are zero for the kept fragments
+    count_columns = [c for c in columns if c not in old_df.columns]
+    frag_sum_df[count_columns] = frag_sum_df[count_columns].fillna(0).astype(int)
+    frag_sum_df = frag_sum_df[columns].rename_axis('Specimen').reset_index()
+    print('Recomputed %d of %d fragments'%(len(changed),len(hashes)))
+else:
+    frag_sum_df = frag_summary(df, frag_df, cat_values)
+
+#Write CSV file
+frag_sum_df.to_csv('frag_level_ml.csv', index=False, na_rep='nan')
+hashes.rename('Hash').rename_axis('Specimen').to_csv(hash_file)
@@ -1,6 +1,7 @@
 import pandas as pd
 import pickle
 import numpy as np
+from break_curves import load_break_counts
 
 def sample_inventory(fields):
     """Sample Inventory
@@ -24,23 +25,9 @@ def sample_inventory(fields):
     df = pd.read_csv('finaldata_inventoryall.csv', encoding = 'cp1252')
     df = df[fields]
 
-    #Load angle data dictionary
-    with open('break_curve_data.pkl', 'rb') as f:
-        angledata = pickle.load(f)
-
-    specimen_list = []
-    for specimen in angledata:
-        specimen_list += [specimen]
-
-    keep = np.zeros(len(df),dtype=bool)
-    for i in range(len(df)):
-        keep[i] = df['Specimen'][i] in specimen_list
-    df = df[keep].reset_index().drop(['index'],axis=1)
-
-    num_breaks = np.zeros(len(df))
-    for i in range(len(df)):
-        num_breaks[i] = len(angledata[df['Specimen'][i]])
-    df['NumBreaks'] = num_breaks.astype(int)
+    #Keep specimens with break curve data, and add their number of breaks
+    num_breaks = load_break_counts()
+    df = df.join(num_breaks, on='Specimen', how='inner').reset_index(drop=True)
 
     return df
 
@@ -1,61 +1,157 @@
 import amaazetools.trimesh as tm
 import pandas as pd
 import numpy as np
+import pickle
+import hashlib
+import time
 import os
-from tqdm import trange
-
-#New dataframe
-df = pd.DataFrame()
-df['Specimen'] = []
-df['Surface Area'] = [] 
-df['Volume'] = []
-df['Bounding Box Dim1'] = []
-df['Bounding Box Dim2'] = []
-df['Bounding Box Dim3'] = []
-df['nv a 1'] = []
-df['nv a 2'] = []
-df['nv a 3'] = []
-df['nv b 1'] = []
-df['nv b 2'] = []
-df['nv b 3'] = []
-df['nv c 1'] = []
-df['nv c 2'] = []
-df['nv c 3'] = []
-
-#Directory to look for ply files in
-directory = '/drive/GoogleDrive/AMAAZE/Papers/ML_Paper/finaldata_VtgonMeshes'
-files = os.listdir(directory)
-for i in trange(len(files)): # If you've got a lot of files, this may take a while
-    filename = files[i]
-    if filename.endswith(".ply"):
-      mesh = tm.load_ply(os.path.join(directory,filename))
-      
-      # The bounding box itself
-      bbox = mesh.bbox()
-      
-      # Bounding box direction vectors
-      _, vecs = tm.pca(mesh.points)
-      
-      # V1 is the longitudinal plane, I believe. 
-      v1 = vecs[:,0] # I'm grabbing all of the vectors in case I'm using the wrong one
-      v2 = vecs[:,1] # Because this script takes forever to run
-      v3 = vecs[:,2] # I think it's because these ply files are pretty big
-      
-      df.loc[len(df)] = [filename[:10], 
-                         mesh.surf_area(),
-                         mesh.volume(), 
-                         bbox[0], 
-                         bbox[1], 
-                         bbox[2],
-                         v1[0],
-                         v1[1],
-                         v1[2],
-                         v2[0],
-                         v2[1],
-                         v2[2],
-                         v3[0],
-                         v3[1],
-                         v3[2]
-                         ]
-
-df.to_csv('mesh_stats.csv',index=False)      
+from multiprocessing import Pool
+from tqdm import tqdm
+from ply_stream import ply_header, ply_streamable, stream_mesh_stats
+
+#Columns of mesh_stats.csv
+columns = ['Specimen',
+           'Surface Area',
+           'Volume',
+           'Bounding Box Dim1',
+           'Bounding Box Dim2',
+           'Bounding Box Dim3',
+           'nv a 1',
+           'nv a 2',
+           'nv a 3',
+           'nv b 1',
+           'nv b 2',
+           'nv b 3',
+           'nv c 1',
+           'nv c 2',
+           'nv c 3']
+
+def file_key(path, content_hash=False):
+    """File Key
+    ========
+
+    Key used to decide whether a mesh has changed since its statistics were cached.
+
+    Parameters
+    ----------
+    path : string
+        Path to file.
+    content_hash : bool (optional), default = False
+        Whether to use a hash of the file contents instead of the size and modification time.
+
+    Returns
+    -------
+    key : tuple
+        Size and modification time of the file, or its SHA1 hash.
+    """
+    if content_hash:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                h.update(block)
+        return ('sha1', h.hexdigest())
+    else:
+        s = os.stat(path)
+        return (s.st_size, s.st_mtime_ns)
+
+def mesh_stats(path, stream=True, chunk_size=1000000):
+    """Mesh Statistics
+    ========
+
+    Computes the statistics of a mesh that are saved to mesh_stats.csv.
+
+    Parameters
+    ----------
+    path : string
+        Path to ply file.
+    stream : bool (optional), default = True
+        Whether to compute the statistics of binary ply files in chunks from a memory map,
+        instead of loading the whole mesh into memory. ASCII ply files, and files with list 
+        properties other than the face vertex indices, are always loaded (see ply_streamable).
+    chunk_size : int (optional), default = 1000000
+        Number of vertices or faces to process at a time when streaming.
+
+    Returns
+    -------
+    row : list
+        Row of mesh_stats.csv, in the same order as columns.
+    """
+    if stream and ply_streamable(ply_header(path)):
+        surf_area, volume, bbox, vecs = stream_mesh_stats(path, chunk_size=chunk_size)
+    else:
+        mesh = tm.load_ply(path)
+
+        # The bounding box itself
+        bbox = mesh.bbox()
+
+        # Bounding box direction vectors
+        _, vecs = tm.pca(mesh.points)
+        surf_area, volume = mesh.surf_area(), mesh.volume()
+
+    # V1 is the longitudinal plane, I believe.
+    v1 = vecs[:,0] # I'm grabbing all of the vectors in case I'm using the wrong one
+    v2 = vecs[:,1]
+    v3 = vecs[:,2]
+
+    return [os.path.basename(path)[:10], surf_area, volume] + list(bbox) + list(v1) + list(v2) + list(v3)
+
+def save_cache(cache, cache_file):
+    """Save Cache
+    ========
+
+    Saves the cache of mesh statistics, replacing the file atomically so an interrupted save does
+    not corrupt it.
+
+    Parameters
+    ----------
+    cache : python dictionary
+        Key and statistics of each mesh, indexed by path.
+    cache_file : string
+        Path to the cache file.
+    """
+    with open(cache_file+'.tmp', 'wb') as f:
+        pickle.dump(cache, f)
+    os.replace(cache_file+'.tmp', cache_file)
+
+
+if __name__ == '__main__':
+
+    #Directory to look for ply files in
+    directory = '/drive/GoogleDrive/AMAAZE/Papers/ML_Paper/finaldata_VtgonMeshes'
+
+    #Number of processes to use
+    num_workers = os.cpu_count()
+
+    #Cache of previously computed statistics, so only new or changed meshes are processed
+    cache_file = 'mesh_stats_cache.pkl'
+    content_hash = False
+
+    #Seconds between saves of the cache while meshes are processed
+    checkpoint_interval = 30
+
+    files = sorted([os.path.join(directory,f) for f in os.listdir(directory) if f.endswith('.ply')])
+
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+
+    keys = {path:file_key(path, content_hash) for path in files}
+    todo = [path for path in files if path not in cache or cache[path]['key'] != keys[path]]
+    print('Computing statistics for %d of %d meshes'%(len(todo),len(files)))
+
+    #Save as we go, at most every checkpoint_interval seconds, and once more at the end (also when interrupted)
+    try:
+        with Pool(num_workers) as pool:
+            last_save = time.monotonic()
+            for path,row in zip(todo, tqdm(pool.imap(mesh_stats, todo), total=len(todo))):
+                cache[path] = {'key':keys[path], 'stats':row}
+                if time.monotonic() - last_save > checkpoint_interval:
+                    save_cache(cache, cache_file)
+                    last_save = time.monotonic()
+    finally:
+        if len(todo) > 0:
+            save_cache(cache, cache_file)
+
+    df = pd.DataFrame([cache[path]['stats'] for path in files], columns=columns)
+    df.to_csv('mesh_stats.csv',index=False)
@@ -0,0 +1,233 @@
+import numpy as np
+
+#PLY property types and the corresponding numpy types
+ply_types = {'char':'i1', 'int8':'i1',
+             'uchar':'u1', 'uint8':'u1',
+             'short':'i2', 'int16':'i2',
+             'ushort':'u2', 'uint16':'u2',
+             'int':'i4', 'int32':'i4',
+             'uint':'u4', 'uint32':'u4',
+             'float':'f4', 'float32':'f4',
+             'double':'f8', 'float64':'f8'}
+
+def ply_header(fname):
+    """PLY Header
+    ========
+
+    Reads the header of a .ply file.
+
+    Parameters
+    ----------
+    fname : string
+        Name of ply file.
+
+    Returns
+    -------
+    header : python dictionary
+        Contains the 'format' ('ascii', 'binary_little_endian' or 'binary_big_endian'),
+        the byte 'offset' where the data starts, and a list of 'elements', each a dictionary
+        with the 'name', 'count' and 'properties' of the element. Properties are tuples
+        (name, type) or (name, count type, item type) for list properties.
+    """
+
+    header = {'format':None, 'offset':0, 'elements':[]}
+    with open(fname, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError('%s is not a ply file'%fname)
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError('End of header not found in %s'%fname)
+            words = line.decode('ascii', errors='replace').split()
+            if len(words) == 0 or words[0] in ['comment', 'obj_info']:
+                continue
+            if words[0] == 'format':
+                header['format'] = words[1]
+            elif words[0] == 'element':
+                header['elements'].append({'name':words[1], 'count':int(words[2]), 'properties':[]})
+            elif words[0] == 'property':
+                if words[1] == 'list':
+                    header['elements'][-1]['properties'].append((words[4], words[2], words[3]))
+                else:
+                    header['elements'][-1]['properties'].append((words[2], words[1]))
+            elif words[0] == 'end_header':
+                header['offset'] = f.tell()
+                break
+
+    return header
+
+def ply_streamable(header):
+    """PLY Streamable
+    ========
+
+    Whether a .ply file can be memory mapped by ply_memmap. The file must be binary, and the only
+    list property must be the vertex indices of the faces, whose records have a fixed size for
+    triangle meshes. Any other list property has records of unknown size.
+
+    Parameters
+    ----------
+    header : python dictionary
+        Header from ply_header.
+
+    Returns
+    -------
+    streamable : bool
+        Whether the file can be memory mapped.
+    """
+    if header['format'] not in ['binary_little_endian', 'binary_big_endian']:
+        return False
+    for element in header['elements']:
+        for prop in element['properties']:
+            if len(prop) == 3 and not (element['name'] == 'face' and prop[0] in ['vertex_indices', 'vertex_index']):
+                return False
+    return True
+
+def element_dtype(element, endian, list_length=3):
+    """Element dtype
+    ========
+
+    Numpy structured dtype for one record of a binary ply element. List properties
+    are assumed to have list_length items, which holds for the faces of triangle meshes.
+
+    Parameters
+    ----------
+    element : python dictionary
+        Element from ply_header.
+    endian : string
+        '<' for little endian or '>' for big endian.
+    list_length : int (optional), default = 3
+        Number of items in each list property.
+
+    Returns
+    -------
+    dtype : numpy dtype
+        Record type of the element.
+    """
+    fields = []
+    for prop in element['properties']:
+        if len(prop) == 3:
+            fields.append((prop[0]+'_count', endian+ply_types[prop[1]]))
+            fields.append((prop[0], endian+ply_types[prop[2]], (list_length,)))
+        else:
+            fields.append((prop[0], endian+ply_types[prop[1]]))
+    return np.dtype(fields)
+
+def ply_memmap(fname):
+    """PLY Memory Map
+    ========
+
+    Memory maps the vertices and triangles of a binary .ply file, without reading them into memory.
+    Raises ValueError for files that cannot be memory mapped (see ply_streamable).
+
+    Parameters
+    ----------
+    fname : string
+        Name of ply file.
+
+    Returns
+    -------
+    vertices : numpy memmap
+        Structured array of vertex records, with fields 'x', 'y' and 'z'.
+    faces : numpy memmap
+        Structured array of face records. The field 'vertex_indices' (or 'vertex_index')
+        holds the indices of the triangle vertices.
+    """
+
+    header = ply_header(fname)
+    if header['format'] == 'binary_little_endian':
+        endian = '<'
+    elif header['format'] == 'binary_big_endian':
+        endian = '>'
+    else:
+        raise ValueError('Only binary ply files can be memory mapped, %s is %s'%(fname,header['format']))
+    if not ply_streamable(header):
+        raise ValueError('%s has list properties other than the face vertex indices, which cannot be memory mapped'%fname)
+
+    arrays = {}
+    offset = header['offset']
+    for element in header['elements']:
+        dtype = element_dtype(element, endian)
+        if element['count'] > 0:
+            arrays[element['name']] = np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=(element['count'],))
+        else:
+            arrays[element['name']] = np.zeros(0, dtype=dtype)
+        offset += element['count']*dtype.itemsize
+
+    return arrays['vertex'], arrays['face']
+
+def stream_mesh_stats(fname, chunk_size=1000000):
+    """Streaming Mesh Statistics
+    ========
+
+    Computes the surface area, volume, bounding box and principal directions of a triangle mesh
+    stored in a binary .ply file, reading the vertices and faces in chunks of chunk_size from a
+    memory map. Memory use is bounded by the chunk size rather than the size of the mesh.
+    The results agree with surf_area, volume, bbox and pca from amaazetools.trimesh, up to
+    the sign of the principal directions.
+
+    Parameters
+    ----------
+    fname : string
+        Name of ply file.
+    chunk_size : int (optional), default = 1000000
+        Number of vertices or faces to process at a time.
+
+    Returns
+    -------
+    surf_area : float
+        Surface area of the mesh.
+    volume : float
+        Volume enclosed by the mesh.
+    bbox : numpy array
+        Dimensions of the bounding box aligned with the principal directions (3,).
+    vecs : numpy array
+        Principal directions as columns, in order of decreasing variance (3,3).
+    """
+
+    vertices, faces = ply_memmap(fname)
+    tri_field = 'vertex_indices' if 'vertex_indices' in faces.dtype.names else 'vertex_index'
+    num_verts = len(vertices)
+    points = lambda i: np.stack((vertices['x'][i],vertices['y'][i],vertices['z'][i]),axis=-1).astype(float)
+
+    #First pass over vertices: mean and covariance, merging chunks with Chan's formula
+    n, mean, M2 = 0, np.zeros(3), np.zeros((3,3))
+    for i in range(0, num_verts, chunk_size):
+        P = points(slice(i, i+chunk_size))
+        m = len(P)
+        mean_c = np.mean(P,axis=0)
+        M2_c = (P - mean_c).T@(P - mean_c)
+        delta = mean_c - mean
+        M2 += M2_c + np.outer(delta,delta)*n*m/(n+m)
+        mean += delta*m/(n+m)
+        n += m
+
+    vals, vecs = np.linalg.eigh(M2)
+    vecs = vecs[:,np.argsort(-vals)]
+
+    #Second pass over vertices: extent along principal directions
+    Y_min, Y_max = np.full(3,np.inf), np.full(3,-np.inf)
+    for i in range(0, num_verts, chunk_size):
+        Y = (points(slice(i, i+chunk_size)) - mean)@vecs
+        Y_min = np.minimum(Y_min,np.min(Y,axis=0))
+        Y_max = np.maximum(Y_max,np.max(Y,axis=0))
+    bbox = Y_max - Y_min
+
+    #Pass over faces: area, and the sums needed for the volume
+    surf_area, CN, C_sum, N_sum = 0, 0, np.zeros(3), np.zeros(3)
+    for i in range(0, len(faces), chunk_size):
+        chunk = faces[i:i+chunk_size]
+        if np.any(chunk[tri_field+'_count'] != 3):
+            raise ValueError('Only triangle meshes are supported, %s has other faces'%fname)
+        T = chunk[tri_field]
+        P1, P2, P3 = points(T[:,0]), points(T[:,1]), points(T[:,2])
+        N = np.cross(P2-P1,P3-P1)
+        C = (P1 + P2 + P3)/3
+        surf_area += np.sum(np.linalg.norm(N,axis=1))/2
+        CN += np.sum(C*N)
+        C_sum += np.sum(C,axis=0)
+        N_sum += np.sum(N,axis=0)
+
+    #Volume is computed relative to the mean of the face centers, as in amaazetools
+    volume = (CN - np.dot(C_sum,N_sum)/max(len(faces),1))/6
+
+    return surf_area, volume, bbox, vecs
@@ -1,20 +1,10 @@
 import pandas as pd
 import numpy as np
 import pickle
-from collections import defaultdict
+from multiprocessing import Pool
+from itertools import permutations
 from scipy import spatial
-
-def tsp_path(D,i):
-    n = D.shape[0]
-    path = [i]
-    length = []
-    for j in range(n-1):
-        path += [np.argmin(D[path[j],:])]
-        length += [D[path[j],path[j+1]]]
-        D[:,path[j]] = np.inf
-    
-    return path,np.array(length)
-
+from break_curves import save_break_curves
 
 def save_curve(x,y,z,idx,break_num,fname):
 
@@ -67,12 +57,148 @@ def plot_curve(x,y,z,idx,break_num):
 
 
 
-def tsp_order(x,y,z):
-    """Travelling SalesPerson (TSP) Ordering
+def path_length(X,path):
+    """Path Length
+    ========
+
+    Computes the length of a path through a point cloud.
+    
+    Parameters
+    ----------
+    X : numpy array
+        Points (n x 3).
+    path : numpy array (int)
+        Indices of the points in the order visited.
+
+    Returns
+    -------
+    length : float
+        Total length of the path.
+    """
+    return np.sum(np.linalg.norm(X[path[1:]] - X[path[:-1]],axis=1))
+
+def exact_path(X):
+    """Exact Path
     ========
 
-    Returns an ordering of the points along a path that minimizes the distance travelled,
-    which is the travelling salesperson (TSP) problem.
+    Finds the shortest path that starts at the first point, ends at the last point, 
+    and visits all other points, by checking every ordering of the interior points.
+    Only feasible for short breaks.
+    
+    Parameters
+    ----------
+    X : numpy array
+        Points (n x 3). The first and last points are the fixed endpoints.
+
+    Returns
+    -------
+    path : numpy array (int)
+        Indices of shortest path.
+    """
+    n = X.shape[0]
+    D = spatial.distance_matrix(X,X)
+    perms = np.array(list(permutations(range(1,n-1))),dtype=int).reshape((-1,n-2))
+    paths = np.hstack((np.zeros((len(perms),1),dtype=int),perms,(n-1)*np.ones((len(perms),1),dtype=int)))
+    lengths = np.sum(D[paths[:,:-1],paths[:,1:]],axis=1)
+    return paths[np.argmin(lengths)]
+
+def nn_path(X,tree,k=8):
+    """Nearest Neighbor Path
+    ========
+
+    Greedy path that starts at the first point and repeatedly walks to the nearest
+    unvisited point, finishing at the last point. Nearest neighbors are found with a KD-tree.
+    
+    Parameters
+    ----------
+    X : numpy array
+        Points (n x 3). The first and last points are the fixed endpoints.
+    tree : scipy.spatial.cKDTree
+        KD-tree built on X.
+    k : int (optional), default = 8
+        Number of neighbors to query at a time. Doubled whenever all of them are visited.
+
+    Returns
+    -------
+    path : numpy array (int)
+        Indices of nearest neighbor path.
+    """
+    n = X.shape[0]
+    visited = np.zeros(n,dtype=bool)
+    visited[0] = True
+    visited[n-1] = True
+    path = np.zeros(n,dtype=int)
+    path[n-1] = n-1
+    for j in range(1,n-1):
+        m = min(k,n)
+        while True:
+            _,nn_ind = tree.query(X[path[j-1]],k=m)
+            nn_ind = np.atleast_1d(nn_ind)
+            free = nn_ind[~visited[nn_ind]]
+            if len(free) > 0 or m == n:
+                break
+            m = min(2*m,n)
+        path[j] = free[0]
+        visited[free[0]] = True
+    return path
+
+def two_opt(X,path,tree,k=8,max_passes=10):
+    """2-opt Refinement
+    ========
+
+    Improves a path with 2-opt moves (reversing a segment of the path) that shorten it.
+    Only moves that connect a point to one of its k nearest neighbors are tried, and at most
+    max_passes sweeps over the path are made. The first and last points stay fixed.
+    
+    Parameters
+    ----------
+    X : numpy array
+        Points (n x 3).
+    path : numpy array (int)
+        Initial path, which is modified in place.
+    tree : scipy.spatial.cKDTree
+        KD-tree built on X.
+    k : int (optional), default = 8
+        Number of nearest neighbors to consider for new edges.
+    max_passes : int (optional), default = 10
+        Maximum number of sweeps over the path.
+
+    Returns
+    -------
+    path : numpy array (int)
+        Refined path.
+    """
+    n = X.shape[0]
+    _,knn_ind = tree.query(X,k=min(k+1,n))
+    pos = np.zeros(n,dtype=int)
+    pos[path] = np.arange(n)
+    dist = lambda a,b: np.sqrt(np.sum((X[a]-X[b])**2))
+
+    for _ in range(max_passes):
+        improved = False
+        for a in range(n):
+            for c in knn_ind[a]:
+                i,j = sorted((pos[a],pos[c]))
+                if j - i < 2 or j == n-1:
+                    continue
+                p,q,r,s = path[i],path[i+1],path[j],path[j+1]
+                gain = dist(p,q) + dist(r,s) - dist(p,r) - dist(q,s)
+                if gain > 1e-12:
+                    path[i+1:j+1] = path[i+1:j+1][::-1].copy()
+                    pos[path[i+1:j+1]] = np.arange(i+1,j+1)
+                    improved = True
+        if not improved:
+            break
+    return path
+
+def endpoint_order(x,y,z,exact_max=9,k=8,max_passes=10):
+    """Endpoint Ordering
+    ========
+
+    Returns an ordering of the points along a break curve whose endpoints are known.
+    The path starts at the first point and ends at the last point (the endpoints from 
+    break_ep_data.csv) and approximately minimizes the distance travelled. Short breaks are
+    solved exactly, and longer breaks use a KD-tree nearest neighbor walk refined by 2-opt.
     
     Parameters
     ----------
@@ -80,105 +206,152 @@ def tsp_order(x,y,z):
         x-coordinates along path.
     y : numpy array
         y-coordinates along path.
-    y : numpy array
-        y-coordinates along path.
+    z : numpy array
+        z-coordinates along path.
+    exact_max : int (optional), default = 9
+        Largest number of points (including endpoints) for which the exact path is computed.
+    k : int (optional), default = 8
+        Number of nearest neighbors used in the nearest neighbor walk and 2-opt.
+    max_passes : int (optional), default = 10
+        Maximum number of 2-opt sweeps.
 
     Returns
     -------
-    min_path : list
-        Indices of TSP ordering.
+    path : list
+        Indices of the ordering.
     """
     n = len(x)
     X = np.stack((x,y,z)).T
-    D = spatial.distance_matrix(X,X)
-    D[range(n),range(n)] = np.inf
-
-    #Try starting from each point
-    min_length = np.ones((n-1,))*np.inf
-    min_path = list(range(n))
-    for i in range(n):
-        path,length = tsp_path(D.copy(),i)
-        if np.sum(length) < np.sum(min_length):
-            min_length = length
-            min_path = path
-    return min_path
-
-
-# Read in the main data
-df = pd.read_csv('finaldata_angle_level.csv', encoding = 'cp1252')
-endpoints_df = pd.read_csv('break_ep_data.csv')
-
-#Sort data
-df = df.sort_values(by=['Mesh_Name','BreakNo'], ignore_index=True)
-endpoints_df = endpoints_df.sort_values(by=['Specimen', 'BreakNo'], ignore_index=True)
-
-# This generates a dictionary of all the meshes, their breaks, and those end points
-endpoints_dict = defaultdict(dict)
-for i in range(len(endpoints_df)):
-    current_mesh = endpoints_df['Specimen'][i]
-    current_break = endpoints_df['BreakNo'][i]
-    ep1 = [endpoints_df['ep1_x'][i], endpoints_df['ep1_y'][i], endpoints_df['ep1_z'][i]]
-    ep2 = [endpoints_df['ep2_x'][i], endpoints_df['ep2_y'][i], endpoints_df['ep2_z'][i]]
-    endpoints_dict[current_mesh].update({current_break: [ep1, ep2]})
+    if n <= 3:
+        return list(range(n))
+    if n <= exact_max:
+        return list(exact_path(X))
+
+    tree = spatial.cKDTree(X)
+    path = nn_path(X,tree,k=k)
+    path = two_opt(X,path,tree,k=k,max_passes=max_passes)
+    return list(path)
+
+
+def break_offsets(mesh_names,break_nums):
+    """Break Offsets
+    ========
+
+    Finds the boundaries of all breaks at once in data sorted by mesh name and break number.
+    Rows offsets[j]:offsets[j+1] are the measurements of the j-th break.
+    
+    Parameters
+    ----------
+    mesh_names : numpy array (string)
+        Mesh name of each row.
+    break_nums : numpy array (int)
+        Break number of each row.
+
+    Returns
+    -------
+    offsets : numpy array (int)
+        Start index of each break, followed by the total number of rows.
+    """
+    change = (mesh_names[1:] != mesh_names[:-1]) | (break_nums[1:] != break_nums[:-1])
+    starts = np.flatnonzero(np.hstack(([True],change)))
+    return np.hstack((starts,len(mesh_names)))
+
+def process_mesh(args):
+    """Process Mesh
+    ========
+
+    Orders the break curves of one mesh and collects their goniometer measurements.
     
-#Empty python dictionary
-angledata = {}
+    Parameters
+    ----------
+    args : tuple
+        (mesh_name, break_nums, offsets, columns, ep1, ep2), where the measurements of break 
+        break_nums[j] are rows offsets[j]:offsets[j+1] of each array in the dictionary columns, 
+        and ep1[j], ep2[j] are its end points.
 
-#Loop over existing dataframe
-start_index = 0
-current_break = df['BreakNo'][0]
-current_mesh = df['Mesh_Name'][0][:10]
-for i in range(len(df)+1):
+    Returns
+    -------
+    mesh_name : string
+        Name of the mesh.
+    breaks : python dictionary
+        Break curve data for each break number.
+    """
+    mesh_name, break_nums, offsets, columns, ep1, ep2 = args
 
-    #Check if we are moving on to a new break # or mesh, or we got to the end of the df
-    if (i == len(df)) or (current_break != df['BreakNo'][i]) or (current_mesh != df['Mesh_Name'][i][:10]):
-        
-        # Get end points of current break
-        ep1, ep2 = endpoints_dict[current_mesh][current_break]
-        x1, y1, z1 = ep1
-        x2, y2, z2 = ep2
-        
-        angles = df['Angle'].values[start_index:i].astype(float)
-        num_vert = df['Number_of_Vertices'].values[start_index:i].astype(int)
-        radius = df['Radius'].values[start_index:i].astype(float)
+    breaks = {}
+    for j,break_num in enumerate(break_nums):
+        s = slice(offsets[j],offsets[j+1])
+        angles = columns['Angle'][s]
         
         # Because of what we're doing here, the xs, ys, and zs are going to be out of order. 
-        x = df['x'].values[start_index:i].astype(float)
-        x = np.hstack([x1, x, x2])
-        
-        y = df['y'].values[start_index:i].astype(float)
-        y = np.hstack([y1, y, y2])
-        
-        z = df['z'].values[start_index:i].astype(float)
-        z = np.hstack([z1, z, z2])
+        x = np.hstack([ep1[j,0], columns['x'][s], ep2[j,0]])
+        y = np.hstack([ep1[j,1], columns['y'][s], ep2[j,1]])
+        z = np.hstack([ep1[j,2], columns['z'][s], ep2[j,2]])
         
         #Order the points correctly along each curve
-        idx = tsp_order(x,y,z)
-        #save_curve(x,y,z,idx,current_break,'../figures/tsp_'+current_mesh+'_'+str(current_break)+'.png')
+        idx = endpoint_order(x,y,z)
+        #save_curve(x,y,z,idx,break_num,'../figures/tsp_'+mesh_name+'_'+str(break_num)+'.png')
         x,y,z = x[idx],y[idx],z[idx]
 
-        fit = df['fit'].values[start_index:i].astype(float)
-        segparam = df['SegParam'].values[start_index:i].astype(float)
+        breaks[break_num] = {'Number of Measurements':len(angles),'Angle':angles, 'Number of Vertices':columns['Number_of_Vertices'][s],
+                             'Radius':columns['Radius'][s], 'x':x, 'y':y, 'z':z, 'Fit':columns['fit'][s], 
+                             'Segmentation Parameter':columns['SegParam'][s]}
+
+    return mesh_name, breaks
+
+
+if __name__ == '__main__':
+
+    #Number of processes to use (1 runs serially)
+    num_workers = 1
+
+    # Read in the main data
+    df = pd.read_csv('finaldata_angle_level.csv', encoding = 'cp1252')
+    endpoints_df = pd.read_csv('break_ep_data.csv')
 
-        #Initialize dictionary if not already initialized
-        if current_mesh not in angledata.keys():
-            angledata[current_mesh] = {}
+    #Sort data once by mesh and break number
+    mesh_names = df['Mesh_Name'].str[:10].values
+    break_nums = df['BreakNo'].values
+    order = np.lexsort((break_nums,mesh_names))
+    mesh_names, break_nums = mesh_names[order], break_nums[order]
+    columns = {'Angle':df['Angle'].values[order].astype(float),
+               'Number_of_Vertices':df['Number_of_Vertices'].values[order].astype(int),
+               'Radius':df['Radius'].values[order].astype(float),
+               'x':df['x'].values[order].astype(float),
+               'y':df['y'].values[order].astype(float),
+               'z':df['z'].values[order].astype(float),
+               'fit':df['fit'].values[order].astype(float),
+               'SegParam':df['SegParam'].values[order].astype(float)}
 
-        #add break curve to dictionary for current mesh name
-        angledata[current_mesh][current_break] = {'Number of Measurements':len(angles),'Angle':angles, 'Number of Vertices':num_vert, 'Radius':radius, 'x':x, 'y':y, 'z':z, 'Fit':fit, 'Segmentation Parameter':segparam}
+    #Boundaries of all breaks, and of the meshes in terms of breaks
+    offsets = break_offsets(mesh_names,break_nums)
+    break_mesh, break_num = mesh_names[offsets[:-1]], break_nums[offsets[:-1]]
+    mesh_offsets = break_offsets(break_mesh,np.zeros(len(break_mesh),dtype=int))
 
-        #If we are not at the end, then setup for next min 
-        if i < len(df):
-            #Set new mesh and break #
-            current_break = df['BreakNo'][i]
-            current_mesh = df['Mesh_Name'][i][:10]
+    # Look up the end points of every break with one indexed join
+    endpoints_df = endpoints_df.set_index(['Specimen','BreakNo'])
+    endpoints = endpoints_df.loc[pd.MultiIndex.from_arrays((break_mesh,break_num))]
+    ep1 = endpoints[['ep1_x','ep1_y','ep1_z']].values
+    ep2 = endpoints[['ep2_x','ep2_y','ep2_z']].values
 
-            #Set start index
-            start_index = i
+    #One task per mesh, with contiguous slices of the data
+    tasks = []
+    for m in range(len(mesh_offsets)-1):
+        b0, b1 = mesh_offsets[m], mesh_offsets[m+1]
+        r0, r1 = offsets[b0], offsets[b1]
+        tasks += [(break_mesh[b0], break_num[b0:b1], offsets[b0:b1+1] - r0, 
+                   {key:val[r0:r1] for key,val in columns.items()}, ep1[b0:b1], ep2[b0:b1])]
 
-#Write dictionary to file
-f = open('break_curve_data.pkl','wb')
-pickle.dump(angledata,f)
-f.close()
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            angledata = dict(pool.map(process_mesh, tasks))
+    else:
+        angledata = dict(map(process_mesh, tasks))
 
+    #Write dictionary to file
+    f = open('break_curve_data.pkl','wb')
+    pickle.dump(angledata,f)
+    f.close()
 
+    #Columnar copy of the dictionary, for fast loading
+    save_break_curves(angledata)
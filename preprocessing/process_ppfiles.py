@@ -1,72 +1,64 @@
 #This is the script that is used to reorganize the data from the .pp files into a .csv format.
-import meshlab_pickedpoints as mpp
+import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
 import glob
-import csv
-
-dir = '../ppfiles/'
-fileList = [f for f in glob.glob(dir + "*.pp")]
-
-fragmentList = []
-for file in fileList:
-    fragmentList.append(mpp.load(file))
-
-class pointsStruct:
-    def __init__(self, name, points):
-        self.name = name
-        self.points = points
-    
-    def collapse(self):
-        out = []
-        for line in self.points:
-            inner = [self.name[len(dir):len(dir)+10], int(line["name"])]
-            inner.extend(line["point"])
-            out.append(inner)
-        return out
-
-arr = np.empty((0,5), int)
-for i in range(len(fileList)):
-    arr = np.append(arr, pointsStruct(fileList[i], fragmentList[i]).collapse(), axis=0)
-pp_df = pd.DataFrame(arr, columns=["Specimen", "Point_Number", "x", "y", "z"])
-
-#Convert to a dictionary
-pp_dict = {}
-for i in range(len(pp_df)):
-
-    specimen = pp_df['Specimen'][i]
-    point_num = int(pp_df['Point_Number'][i])
-    x,y,z = pp_df['x'][i],pp_df['y'][i],pp_df['z'][i]
-
-    #Initialize dictionary if not already initialized
-    if specimen not in pp_dict.keys():
-        pp_dict[specimen] = {}
-
-    pp_dict[specimen][point_num] = [x,y,z]
-
-df = pd.read_csv("manual_break_level.csv", usecols = ['Specimen', 'BreakNo', 'ep1', 'ep2'])
-df["ep1_x"] = 0 
-df["ep1_y"] = 0
-df["ep1_z"] = 0
-
-df["ep2_x"] = 0
-df["ep2_y"] = 0
-df["ep2_z"] = 0
-
-for i in range(len(df)):
-    specimen = df['Specimen'][i]
-    ep1 = df['ep1'][i]
-    ep2 = df['ep2'][i]
-
-    df.loc[i, "ep1_x"] = pp_dict[specimen][ep1][0]
-    df.loc[i, "ep1_y"] = pp_dict[specimen][ep1][1]
-    df.loc[i, "ep1_z"] = pp_dict[specimen][ep1][2]
-
-    df.loc[i, "ep2_x"] = pp_dict[specimen][ep2][0]
-    df.loc[i, "ep2_y"] = pp_dict[specimen][ep2][1]
-    df.loc[i, "ep2_z"] = pp_dict[specimen][ep2][2]
-
-df.to_csv('break_ep_data.csv', index=False)
-
-
-
+import os
+from multiprocessing import Pool
+
+def load_pp(fname):
+    """Load Picked Points
+    ========
+
+    Reads the points from a meshlab picked points (.pp) file with a streaming XML parser.
+
+    Parameters
+    ----------
+    fname : string
+        Name of pp file.
+
+    Returns
+    -------
+    specimen : string
+        Specimen name (first 10 characters of the file name).
+    point_nums : numpy array (int)
+        Number (name) of each point.
+    points : numpy array (float)
+        Coordinates of each point (num_points x 3).
+    """
+    point_nums = []
+    points = []
+    for _, elem in ET.iterparse(fname):
+        if elem.tag == 'point':
+            point_nums.append(int(elem.get('name')))
+            points.append([float(elem.get('x')), float(elem.get('y')), float(elem.get('z'))])
+            elem.clear()
+
+    return os.path.basename(fname)[:10], np.array(point_nums,dtype=int), np.array(points,dtype=float).reshape((-1,3))
+
+
+if __name__ == '__main__':
+
+    dir = '../ppfiles/'
+    fileList = sorted(glob.glob(dir + "*.pp"))
+
+    #Parse all files in parallel
+    with Pool() as pool:
+        fragmentList = pool.map(load_pp, fileList, chunksize=32)
+
+    #Flat table of all points
+    specimens, point_nums, points = zip(*fragmentList)
+    points = np.vstack(points)
+    pp_df = pd.DataFrame({'Specimen':np.repeat(specimens, [len(p) for p in point_nums]),
+                          'Point_Number':np.hstack(point_nums),
+                          'x':points[:,0], 'y':points[:,1], 'z':points[:,2]})
+    pp_df = pp_df.drop_duplicates(['Specimen','Point_Number'], keep='last').set_index(['Specimen','Point_Number'])
+
+    #Look up the coordinates of both end points of every break
+    df = pd.read_csv("manual_break_level.csv", usecols = ['Specimen', 'BreakNo', 'ep1', 'ep2'])
+    for ep in ['ep1','ep2']:
+        ep_points = pp_df.loc[pd.MultiIndex.from_arrays((df['Specimen'], df[ep]))]
+        for c in ['x','y','z']:
+            df[ep+'_'+c] = ep_points[c].values
+
+    df.to_csv('break_ep_data.csv', index=False)
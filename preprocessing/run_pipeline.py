@@ -0,0 +1,233 @@
+#Runs the preprocessing scripts in order, re-running only the stages whose inputs changed.
+import subprocess
+import threading
+import hashlib
+import contextlib
+import glob
+import json
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#Directory with the raw meshes used by mesh_stats.py
+mesh_directory = '/drive/GoogleDrive/AMAAZE/Papers/ML_Paper/finaldata_VtgonMeshes'
+
+#Stages of the pipeline, with the files (or glob patterns) they read and write.
+#A stage depends on every stage that writes one of its inputs.
+stages = {'ppfiles':{'script':'process_ppfiles.py',
+                     'inputs':['../ppfiles/*.pp','manual_break_level.csv'],
+                     'outputs':['break_ep_data.csv']},
+          'VG_data':{'script':'process_VG_data.py',
+                     'inputs':['finaldata_angle_level.csv','break_ep_data.csv','break_curves.py'],
+                     'outputs':['break_curve_data.pkl','break_curve_data/*.npy','break_curve_data/break_counts.csv']},
+          'mesh_stats':{'script':'mesh_stats.py',
+                        'inputs':[os.path.join(mesh_directory,'*.ply'),'ply_stream.py'],
+                        'outputs':['mesh_stats.csv']},
+          'frag_data':{'script':'frag_data.py',
+                       'inputs':['finaldata_inventoryall.csv','finaldata_trabecula.csv','mesh_stats.csv',
+                                 'break_curve_data/break_counts.csv','inventory.py','break_curves.py'],
+                       'outputs':['frag_data.csv']},
+          'break_level_ml':{'script':'compile_break_level_ml.py',
+                            'inputs':['break_curve_data/*.npy','mesh_stats.csv','manual_break_level.csv',
+                                      'frag_data.csv','break_curves.py'],
+                            'outputs':['break_level_ml.csv']},
+          'frag_level_ml':{'script':'compile_frag_level_ml.py',
+                           'inputs':['break_level_ml.csv','frag_data.csv'],
+                           'outputs':['frag_level_ml.csv']}}
+
+#Number of stages that can run at the same time
+num_workers = 4
+
+#File recording the input fingerprints of the last successful run of each stage
+state_file = 'pipeline_state.json'
+
+def file_hash(path, hash_cache, lock=None):
+    """File Hash
+    ========
+
+    SHA1 hash of the contents of a file. Hashes are cached by path, size and modification time,
+    so unchanged files are not read again.
+
+    Parameters
+    ----------
+    path : string
+        Path to file.
+    hash_cache : python dictionary
+        Cache of previously computed hashes, which is updated.
+    lock : threading.Lock (optional)
+        Lock protecting hash_cache. Only held to look up and store the hash, not while reading the file.
+
+    Returns
+    -------
+    h : string
+        Hex digest of the file contents.
+    """
+    s = os.stat(path)
+    key = [s.st_size, s.st_mtime_ns]
+    lock = contextlib.nullcontext() if lock is None else lock
+    with lock:
+        if path in hash_cache and hash_cache[path][0] == key:
+            return hash_cache[path][1]
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    with lock:
+        hash_cache[path] = [key, h.hexdigest()]
+    return h.hexdigest()
+
+def expand(patterns):
+    """Expand
+    ========
+
+    Expands a list of file names and glob patterns.
+
+    Parameters
+    ----------
+    patterns : list
+        File names or glob patterns.
+
+    Returns
+    -------
+    files : list
+        Sorted list of existing files matching the patterns.
+    missing : list
+        Patterns that did not match any file.
+    """
+    files, missing = [], []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            missing += [pattern]
+        files += matches
+    return files, missing
+
+def fingerprint(stage, hash_cache, lock=None):
+    """Fingerprint
+    ========
+
+    Combined hash of the script and all input files of a stage.
+
+    Parameters
+    ----------
+    stage : python dictionary
+        Stage from stages.
+    hash_cache : python dictionary
+        Cache of file hashes (see file_hash).
+    lock : threading.Lock (optional)
+        Lock protecting hash_cache.
+
+    Returns
+    -------
+    h : string
+        Hex digest identifying the current inputs of the stage.
+    missing : list
+        Input patterns that did not match any file.
+    """
+    files, missing = expand([stage['script']] + stage['inputs'])
+    h = hashlib.sha1()
+    for path in files:
+        h.update(path.encode() + b'\0' + file_hash(path, hash_cache, lock).encode() + b'\0')
+    return h.hexdigest(), missing
+
+def dependencies(stages):
+    """Dependencies
+    ========
+
+    Finds the stages each stage depends on, from the inputs and outputs of the stages.
+
+    Parameters
+    ----------
+    stages : python dictionary
+        Stages of the pipeline.
+
+    Returns
+    -------
+    deps : python dictionary
+        Set of names of the stages each stage depends on.
+    """
+    deps = {}
+    for name,stage in stages.items():
+        deps[name] = set([other for other in stages if other != name and
+                          any(i == o for i in stage['inputs'] for o in stages[other]['outputs'])])
+    return deps
+
+def run_stage(name, state, hash_cache, lock):
+    """Run Stage
+    ========
+
+    Runs a stage if its inputs changed since its last successful run, or any output is missing.
+    Stages whose raw inputs are not available are skipped if their outputs already exist.
+
+    Parameters
+    ----------
+    name : string
+        Name of the stage.
+    state : python dictionary
+        Fingerprints of the last successful run of each stage, which is updated.
+    hash_cache : python dictionary
+        Cache of file hashes.
+    lock : threading.Lock
+        Lock protecting state and hash_cache.
+
+    Returns
+    -------
+    status : string
+        'ran', 'up to date' or 'skipped'.
+    """
+    stage = stages[name]
+
+    #Hash the inputs without holding the lock, so other stages are not blocked while large files are read
+    fp, missing = fingerprint(stage, hash_cache, lock)
+    _, missing_outputs = expand(stage['outputs'])
+
+    if len(missing) > 0:
+        if len(missing_outputs) == 0:
+            return 'skipped'
+        raise FileNotFoundError('Stage %s is missing inputs %s and outputs %s'%(name,missing,missing_outputs))
+    with lock:
+        up_to_date = state.get(name) == fp
+    if up_to_date and len(missing_outputs) == 0:
+        return 'up to date'
+
+    subprocess.run([sys.executable, stage['script']], check=True)
+
+    with lock:
+        state[name] = fp
+        save_state(state, hash_cache)
+    return 'ran'
+
+def save_state(state, hash_cache):
+    with open(state_file+'.tmp', 'w') as f:
+        json.dump({'stages':state, 'hashes':hash_cache}, f)
+    os.replace(state_file+'.tmp', state_file)
+
+
+if __name__ == '__main__':
+
+    state, hash_cache = {}, {}
+    if os.path.isfile(state_file):
+        with open(state_file) as f:
+            saved = json.load(f)
+        state, hash_cache = saved['stages'], saved['hashes']
+
+    #Run each stage once all stages it depends on are done, with independent stages in parallel
+    deps = dependencies(stages)
+    lock = threading.Lock()
+    pending, running, done = set(stages), {}, set()
+    with ThreadPoolExecutor(num_workers) as pool:
+        while pending or running:
+            for name in sorted(pending):
+                if deps[name] <= done:
+                    running[pool.submit(run_stage, name, state, hash_cache, lock)] = name
+                    pending.remove(name)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                print('%s: %s'%(name, future.result()))
+                done.add(name)
+
+    with lock:
+        save_state(state, hash_cache)
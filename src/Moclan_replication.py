@@ -13,7 +13,7 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
-from utils import Net
+from utils import Net, kernel_matrix, NeighborIndex
 
 def moclan_dataset(bootstrap=False, bootstrap_num=1, level = 'moclan', dataset='moclan'):
     """Moclan Dataset
@@ -90,7 +90,7 @@ def moclan_dataset(bootstrap=False, bootstrap_num=1, level = 'moclan', dataset='
     return (data, target, test_name)
 
 
-def run_test(data, target, test_name, rf_np = False, reps = 300, folds = 10, k = 25, n_jobs=1):
+def run_test(data, target, test_name, rf_np = False, reps = 300, folds = 10, k = 25, n_jobs=1, precomputed_kernel=False, knn_index=False):
     """Moclan Dataset
     ========
 
@@ -114,6 +114,13 @@ def run_test(data, target, test_name, rf_np = False, reps = 300, folds = 10, k =
         The number of k-nearest neighbors used in k-nearest neighbors classification
     n_jobs : int (optional), default=1
         Number of jobs to run in parallel.
+    precomputed_kernel : boolean (optional), default=False
+        If you want the linear SVM to be fit on sub-blocks of a kernel matrix computed once, instead of
+        evaluating the kernel in every fold. The data is then standardized with a scaler fit on all of the
+        data, instead of the training folds.
+    knn_index : boolean (optional), default=False
+        If you want KNN to use a neighbor index of all of the data built once (see utils.NeighborIndex), 
+        instead of a new search in every fold. The data is then standardized with a scaler fit on all of the data.
 
     Returns
     -------
@@ -135,10 +142,16 @@ def run_test(data, target, test_name, rf_np = False, reps = 300, folds = 10, k =
     r["Results"]["Random Forest"] = {"accuracy" : np.mean(rf_acc), "std" : np.std(rf_acc)}
     
     # Support Vector Machines
-    clfsvm = SVC(kernel ="linear", max_iter = 5000)
-    scalar = StandardScaler() # SVM works best with standard scaled data
-    pipeline = Pipeline([('transformer', scalar), ('estimator', clfsvm)]) # That's what this does, in a safe manner
-    svm_acc = 100*cross_val_score(pipeline, data, target, cv = cv, scoring = 'accuracy', n_jobs=n_jobs)
+    if(precomputed_kernel):
+        # Folds are sliced out of the kernel matrix of all of the data
+        clfsvm = SVC(kernel ="precomputed", max_iter = 5000)
+        K = kernel_matrix(StandardScaler().fit_transform(data), 'linear')
+        svm_acc = 100*cross_val_score(clfsvm, K, target, cv = cv, scoring = 'accuracy', n_jobs=n_jobs)
+    else:
+        clfsvm = SVC(kernel ="linear", max_iter = 5000)
+        scalar = StandardScaler() # SVM works best with standard scaled data
+        pipeline = Pipeline([('transformer', scalar), ('estimator', clfsvm)]) # That's what this does, in a safe manner
+        svm_acc = 100*cross_val_score(pipeline, data, target, cv = cv, scoring = 'accuracy', n_jobs=n_jobs)
     r["Results"]["Linear SVM"] = {"accuracy" : np.mean(svm_acc), "std" : np.std(svm_acc)}
 
     # LDA
@@ -152,10 +165,15 @@ def run_test(data, target, test_name, rf_np = False, reps = 300, folds = 10, k =
     r["Results"]["GNB"] = {"accuracy" : np.mean(gnb_acc), "std" : np.std(gnb_acc)}
 
     # KNN
-    clfknn= KNeighborsClassifier(n_neighbors = k)
-    scalar = StandardScaler()
-    pipeline = Pipeline([('transformer', scalar), ('estimator', clfknn)])
-    knn_acc = 100*cross_val_score(pipeline, data, target, cv = cv, scoring='accuracy', n_jobs=n_jobs)
+    if(knn_index):
+        # Each fold filters the neighbor lists of all of the data to its training rows
+        index = NeighborIndex(StandardScaler().fit_transform(data), n_neighbors = k)
+        knn_acc = np.array([100*np.mean(index.predict(train, test, target) == target[test]) for train, test in cv.split(data)])
+    else:
+        clfknn= KNeighborsClassifier(n_neighbors = k)
+        scalar = StandardScaler()
+        pipeline = Pipeline([('transformer', scalar), ('estimator', clfknn)])
+        knn_acc = 100*cross_val_score(pipeline, data, target, cv = cv, scoring='accuracy', n_jobs=n_jobs)
     r["Results"]["KNN"] = {"accuracy" : np.mean(knn_acc), "std" : np.std(knn_acc)}
 
     #Neural Networks
@@ -3,6 +3,10 @@ import csv
 import numpy as np
 import os
 import sys
+import json
+import hashlib
+import shutil
+import tempfile
 from pandas import DataFrame
 from datetime import datetime
 from warnings import simplefilter
@@ -15,11 +19,12 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.preprocessing import LabelBinarizer
 from sklearn.preprocessing import StandardScaler
 from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
 from sklearn.metrics import f1_score
 from sklearn.metrics import confusion_matrix
-from tqdm import trange
+from tqdm import tqdm
+from multiprocessing import Pool
+import torch
 
 def create_dataset(options):
     """Create Dataset
@@ -71,148 +76,547 @@ def create_dataset(options):
     sum_stats = options["sum_stats"] 
     count_fields = options["count_fields"] 
         
-    if(dataset == "breaks"):
-        data, target, specimens, _, _ = utils.break_level_ml_dataset(numerical_fields, categorical_fields, target_field)
-    elif(dataset == "frags"):
-        data, target, specimens, _ = utils.frag_level_ml_dataset(numerical_fields, categorical_fields, sum_stats_fields, sum_stats, count_fields, target_field)
-    else:
-        raise ValueError("dataset must be 'breaks' or 'frags'")
+    #All feature subsets of a dataset are selected from one cached master dataset
+    spec = utils.FeatureSpec(dataset, numerical_fields, categorical_fields, sum_stats_fields, sum_stats, count_fields, target_field)
+    data, target, specimens = spec.load()
 
     return data, target, specimens
 
-def run_test(data, target, specimens, dataset_level, desc, results={}, reps=300):
-    """Run Test
+# Names of the classifiers created by classifiers, in order
+classifier_names = ["Random Forest", "Extra Trees", "SVM - Linear", "SVM - RBF", "Neural Network", 
+                    "Linear Discriminant Analysis", "Gaussian Naive Bayes", "K-Nearest Neighbor"]
+
+def classifiers(num_features, num_classes, precomputed_kernels=False, knn_index=None, cuda=True, ensemble=False):
+    """Classifiers
     ========
 
-    Runs the given test the given number of replications. 
+    Creates the classifiers that are compared in each test.
 
     Parameters
     ----------
-    data : numpy array (float)
-        Features.
-    target : numpy array (int)
-        Targets.
-    specimen : numpy array (float)
-        List of specimen names.
-    dataset_level : string
-        Name of the test.
-    name : string
-        string appended to the save file.
-    results : python dictionary (optional), default = {}
-        Holds the results of previous tests.
-    reps : int (optional), default = 300
-        How replications you want to do
+    num_features : int
+        Number of features.
+    num_classes : int
+        Number of classes.
+    precomputed_kernels : bool (optional), default = False
+        Whether the SVMs use precomputed kernel matrices (see run_test).
+    knn_index : utils.NeighborIndex (optional)
+        Neighbor index of all rows, used for KNN instead of a search in every split (see run_test).
+    cuda : bool (optional), default = True
+        Whether the neural network uses the GPU, if found.
+    ensemble : bool (optional), default = False
+        Whether the neural networks of many replications are trained together (see run_ensemble).
 
     Returns
     -------
-    results : python dictionary
-        Dictionary that contains all the results. 
+    clf_ls : list
+        Classifiers.
+    clf_name : list
+        Names of the classifiers (classifier_names).
+    clf_input : list
+        Input of each classifier: 'raw' features, 'scaled' (standardized) features, a precomputed 
+        'kernel' matrix, or the train and test row indices for an 'index'. All scaled classifiers share one scaler, and one copy of the scaled data, 
+        in each split (see run_rep). A neural network trained in an 'ensemble' is skipped by run_rep.
     """
-
-    # Set-up
-    # This suppresses linear svm convergence warnings.
-    simplefilter(action='ignore', category=ConvergenceWarning)
     
     clf_ls = []
-    clf_name = []
+    clf_input = []
     
     # Random Forest
     clf_ls.append(RandomForestClassifier())
-    clf_name.append("Random Forest")
+    clf_input.append("raw")
     
     # Extra Trees
     clf_ls.append(ExtraTreesClassifier())
-    clf_name.append("Extra Trees")
+    clf_input.append("raw")
     
     # SVM - Linear
-    clf = SVC(kernel="linear", max_iter=5000)
-    scaler = StandardScaler()
-    pipeline = Pipeline([('transformer', scaler), ('estimator', clf)])
-    
-    clf_ls.append(pipeline)
-    clf_name.append("SVM - Linear")
+    if precomputed_kernels:
+        clf_ls.append(SVC(kernel="precomputed", max_iter=5000))
+        clf_input.append("kernel")
+    else:
+        clf_ls.append(SVC(kernel="linear", max_iter=5000))
+        clf_input.append("scaled")
     
     # SVM - RBF
-    clf = SVC(kernel="rbf", max_iter=5000)
-    scaler = StandardScaler()
-    pipeline = Pipeline([('transformer', scaler), ('estimator', clf)])
-    
-    clf_ls.append(pipeline)
-    clf_name.append("SVM - RBF")
+    if precomputed_kernels:
+        clf_ls.append(SVC(kernel="precomputed", max_iter=5000))
+        clf_input.append("kernel")
+    else:
+        clf_ls.append(SVC(kernel="rbf", max_iter=5000))
+        clf_input.append("scaled")
     
     # Neural Network
-    num_features = data.shape[1]
-    num_classes = np.max(target)+1
-    nn = utils.Net(structure=[num_features,100,1000,5000], num_classes=num_classes, dropout_rate=0.4,epochs=100,learning_rate=1,cuda=True)
-    scaler = StandardScaler()
-    pipeline = Pipeline([('transformer', scaler), ('estimator', nn)])
-    
-    clf_ls.append(pipeline)
-    clf_name.append("Neural Network")
+    nn = utils.Net(structure=[num_features,100,1000,5000], num_classes=num_classes, dropout_rate=0.4,epochs=100,learning_rate=1,cuda=cuda)
+    clf_ls.append(nn)
+    clf_input.append("ensemble" if ensemble else "scaled")
     
     # LDA
     clf_ls.append(LinearDiscriminantAnalysis())
-    clf_name.append("Linear Discriminant Analysis")
+    clf_input.append("raw")
     
     # GNB
     clf_ls.append(GaussianNB())
-    clf_name.append("Gaussian Naive Bayes")
+    clf_input.append("raw")
     
     # KNN
-    clf = KNeighborsClassifier(n_neighbors=25) # Seemed like a good number at the time
-    scalar = StandardScaler()
-    pipeline = Pipeline([('transformer', scalar), ('estimator', clf)])
-    
-    clf_ls.append(pipeline)
-    clf_name.append("K-Nearest Neighbor")
-    
-    r = {"Test": dataset_level+desc, "dataset": dataset_level, "reps": reps, "Specimens" : np.unique(specimens), "Results": {}}
-    
-    frag_ls = []
-    target_ls = []
-    frag_dict = {}
-    component_dict = {}
-    for i, frag in enumerate(specimens):
-        frag_dict[frag] = {"Truth" : target[i], "Appearences" : 0}
-        component_dict[frag] = {"Truth" : target[i], "Appearences" : 0}
-    
-    for i, clf in enumerate(clf_ls):
-        name = clf_name[i]
-        for frag in frag_dict.keys():
-            frag_dict[frag][name] = 0
-            component_dict[frag][name] = 0
-        r["Results"][name] = {"iter pred": [], "iter vote": []}
-    
-    iter_description = "Test: " + r["Test"] + ". Reps"
-    for i in trange(reps, desc=iter_description):
-        data_train, target_train, data_test, target_test, frag_test = utils.train_test_split(data, target, specimens)
-        for ii, clf in enumerate(clf_ls):
-            name = clf_name[ii]
-            clf.fit(data_train, target_train)
-            pred = clf.predict(data_test)
-            vote = utils.specimen_voting(pred, target_test, frag_test)
-            r["Results"][name]["iter pred"].extend(pred)
-            r["Results"][name]["iter vote"].append(vote)
-            
-        frag_ls.extend(frag_test)
-        target_ls.extend(target_test)
-        
-        unique_frags = np.unique(frag_test)
-        for frag in unique_frags:
-            frag_dict[frag]["Appearences"] += 1
-        
-        for frag in frag_test:
-            component_dict[frag]["Appearences"] += 1
-        
-    r["Truth Frags"] = frag_ls
-    r["Truth Targets"] = target_ls
-    r["Count Frags"] = frag_dict
-    r["Components"] = component_dict        
+    if knn_index is not None:
+        clf_ls.append(knn_index)
+        clf_input.append("index")
+    else:
+        clf_ls.append(KNeighborsClassifier(n_neighbors=25)) # Seemed like a good number at the time
+        clf_input.append("scaled")
+    
+    return clf_ls, list(classifier_names), clf_input
+
+# Data and classifiers of the current test, set once in each worker process by init_worker
+worker = {}
+
+def init_worker(data, target, specimens, torch_threads, kernel_files=None, knn_index=None, cuda=True, ensemble=False):
+    """Initialize Worker
+    ========
+
+    Stores the data of a test, and creates the classifiers, in the (worker) process that runs replications.
+
+    Parameters
+    ----------
+    data : numpy array (float)
+        Features.
+    target : numpy array (int)
+        Targets.
+    specimens : numpy array (string)
+        List of specimen names.
+    torch_threads : int
+        Number of threads torch uses for the neural network.
+    kernel_files : python dictionary (optional)
+        Files with the precomputed kernel matrix of each SVM, which are memory mapped.
+    knn_index : utils.NeighborIndex (optional)
+        Neighbor index used for KNN.
+    cuda : bool (optional), default = True
+        Whether the neural network uses the GPU, if found.
+    ensemble : bool (optional), default = False
+        Whether the neural networks are trained by run_ensemble instead of run_rep.
+    """
+    
+    # This suppresses linear svm convergence warnings.
+    simplefilter(action='ignore', category=ConvergenceWarning)
+    
+    worker["data"], worker["target"], worker["specimens"] = data, target, specimens
+    worker["clf_ls"], worker["clf_name"], worker["clf_input"] = classifiers(data.shape[1], np.max(target)+1, kernel_files is not None, knn_index, cuda, ensemble)
+    worker["kernels"] = {} if kernel_files is None else {name: np.load(f, mmap_mode='r') for name, f in kernel_files.items()}
+    worker["torch_threads"] = torch_threads
+
+def rep_seeds(seed):
+    """Replication Seeds
+    ========
+
+    Seeds of the split, numpy and torch random states of a replication. They are
+    the children of the replication seed, derived without changing its state.
+
+    Parameters
+    ----------
+    seed : numpy SeedSequence
+        Seed of the replication.
+
+    Returns
+    -------
+    seeds : list
+        The three seeds (numpy SeedSequence).
+    """
+    return [np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (k,)) for k in range(3)]
+
+def run_rep(seed):
+    """Run Replication
+    ========
+
+    Runs one replication (a random train/test split) with all classifiers, in a process set up by init_worker.
+    All randomness comes from the seed, so the result does not depend on which process runs it.
+
+    Parameters
+    ----------
+    seed : numpy SeedSequence
+        Seed of the replication.
+
+    Returns
+    -------
+    test : numpy array (int)
+        Indices of the test rows.
+    preds : numpy array (int)
+        Predictions of each classifier on the test rows (classifiers x test rows).
+    """
+    
+    split_seed, np_seed, torch_seed = rep_seeds(seed)
+    
+    # Classifiers without a random_state use the global numpy and torch random states
+    np.random.seed(np_seed.generate_state(1)[0])
+    torch.manual_seed(int(torch_seed.generate_state(1, dtype=np.uint64)[0]))
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(worker["torch_threads"])
+    
+    data, target, specimens = worker["data"], worker["target"], worker["specimens"]
+    train, test = utils.split_indices(specimens, rng=np.random.default_rng(split_seed))
+    data_train, target_train = data[train], target[train]
+    data_test = data[test]
+    
+    # One scaler per split, shared by all classifiers that use standardized features
+    if "scaled" in worker["clf_input"]:
+        scaler = StandardScaler().fit(data_train)
+        scaled_train, scaled_test = scaler.transform(data_train), scaler.transform(data_test)
+    
+    preds = np.zeros((len(worker["clf_ls"]), len(test)), dtype=np.int8)
+    try:
+        for ii, (clf, name, clf_input) in enumerate(zip(worker["clf_ls"], worker["clf_name"], worker["clf_input"])):
+            if clf_input == "ensemble":
+                continue
+            elif clf_input == "scaled":
+                clf.fit(scaled_train, target_train)
+                preds[ii] = clf.predict(scaled_test)
+            elif clf_input == "kernel":
+                K = worker["kernels"][name]
+                clf.fit(K[np.ix_(train, train)], target_train)
+                preds[ii] = clf.predict(K[np.ix_(test, train)])
+            elif clf_input == "index":
+                preds[ii] = clf.predict(train, test, target)
+            else:
+                clf.fit(data_train, target_train)
+                preds[ii] = clf.predict(data_test)
+    finally:
+        torch.set_num_threads(num_threads)
+    
+    return test, preds
+
+def run_ensemble(seeds):
+    """Run Ensemble
+    ========
+
+    Trains the neural networks of a block of replications at once with utils.NetEnsemble, in a 
+    process set up by init_worker. Each replica is trained on the training rows of its replication, 
+    standardized with a scaler fit on them, as in run_rep. The random states of the networks come 
+    from the seed of the first replication.
+
+    Parameters
+    ----------
+    seeds : list
+        Seeds of the replications (numpy SeedSequence).
+
+    Returns
+    -------
+    preds : numpy array (int)
+        Predictions of the network of each replication on all rows (replications x rows).
+    """
+    
+    net = worker["clf_ls"][worker["clf_input"].index("ensemble")]
+    data, target, specimens = worker["data"], worker["target"], worker["specimens"]
+    
+    # Same splits and scalers as run_rep
+    masks = np.zeros((len(seeds), len(target)), dtype=bool)
+    mean, scale = np.zeros((len(seeds), data.shape[1])), np.ones((len(seeds), data.shape[1]))
+    for r, seed in enumerate(seeds):
+        train, _ = utils.split_indices(specimens, rng=np.random.default_rng(rep_seeds(seed)[0]))
+        masks[r, train] = True
+        scaler = StandardScaler().fit(data[train])
+        mean[r], scale[r] = scaler.mean_, scaler.scale_
+    
+    # The torch seed is a fourth child of the first replication seed (see rep_seeds)
+    first = seeds[0]
+    torch.manual_seed(int(np.random.SeedSequence(first.entropy, spawn_key=first.spawn_key + (3,)).generate_state(1, dtype=np.uint64)[0]))
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(worker["torch_threads"])
+    try:
+        ensemble = utils.NetEnsemble(num_replicas=len(seeds), structure=net.structure, num_classes=net.num_classes, 
+                                     dropout_rate=net.dropout_rate, epochs=net.epochs, cuda=net.cuda, 
+                                     learning_rate=net.learning_rate, batch_size=net.batch_size, gamma=net.gamma, shuffle=net.shuffle)
+        ensemble.fit(data, target, masks, mean, scale)
+        preds = ensemble.predict(data)
+    finally:
+        torch.set_num_threads(num_threads)
+    
+    return preds
+
+def data_fingerprint(data, target, specimens):
+    """Data Fingerprint
+    ========
+
+    SHA1 hash of the data of a test, stored in the replication log so that a log is only resumed
+    with the same data.
+
+    Parameters
+    ----------
+    data : numpy array (float)
+        Features.
+    target : numpy array (int)
+        Targets.
+    specimens : numpy array (string)
+        List of specimen names.
+
+    Returns
+    -------
+    h : string
+        Hex digest of the shapes, types and contents of the arrays.
+    """
+    h = hashlib.sha1()
+    for a in [data, target, specimens]:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+def read_log(log_file):
+    """Read Log
+    ========
+
+    Reads the replication log of a test (see run_test). An incomplete last line, left by a 
+    crash while writing, is removed from the file.
+
+    Parameters
+    ----------
+    log_file : string
+        Path to the log file.
+
+    Returns
+    -------
+    header : python dictionary
+        Test name, seed, classifier names, classifier options, data fingerprint and number of
+        replications of the logged test, or None if there is no log.
+    records : python dictionary
+        Logged replications, indexed by replication number.
+    """
+    if not os.path.isfile(log_file):
+        return None, {}
+    
+    with open(log_file, 'rb') as f:
+        lines = f.read().split(b'\n')
+    
+    # Everything after the last newline is incomplete
+    complete = lines[:-1]
+    size = sum(len(line)+1 for line in complete)
+    if size < os.path.getsize(log_file):
+        with open(log_file, 'r+b') as f:
+            f.truncate(size)
+    
+    if len(complete) == 0:
+        return None, {}
+    records = [json.loads(line) for line in complete[1:]]
+    return json.loads(complete[0]), {record["rep"]: record for record in records}
+
+def append_log(f, record):
+    """Append Log
+    ========
+
+    Appends one record to a log file as a single line, and flushes it to disk.
+
+    Parameters
+    ----------
+    f : file
+        Log file opened for appending in binary mode.
+    record : python dictionary
+        Record to write.
+    """
+    f.write((json.dumps(record) + '\n').encode())
+    f.flush()
+    os.fsync(f.fileno())
+
+def run_test(data, target, specimens, dataset_level, desc, results=None, reps=300, num_workers=1, seed=None, torch_threads=1, log_file=None, precomputed_kernels=False, knn_index=False, nn_replicas=None):
+    """Run Test
+    ========
+
+    Runs the given test the given number of replications. The replications can run in parallel 
+    in worker processes, which receive the data once. Each replication has its own seed derived from 
+    the seed of the test, so the results are identical for any number of workers.
+    
+    With a log file, the test indices and predictions of every finished replication are appended to 
+    the log, and replications already in the log are not run again. An interrupted test is resumed 
+    by running it again with the same log file, and the result is identical to an uninterrupted run.
+
+    Parameters
+    ----------
+    data : numpy array (float)
+        Features.
+    target : numpy array (int)
+        Targets.
+    specimen : numpy array (float)
+        List of specimen names.
+    dataset_level : string
+        Name of the test.
+    name : string
+        string appended to the save file.
+    results : python dictionary (optional)
+        Holds the results of previous tests.
+    reps : int (optional), default = 300
+        How replications you want to do
+    num_workers : int (optional), default = 1
+        Number of worker processes. Runs in this process if 1. The neural network only uses the GPU
+        when running in this process, so that the workers do not each open a CUDA context.
+    seed : int (optional)
+        Seed of the test. A random seed is used if not provided, and saved in the results.
+    torch_threads : int (optional), default = 1
+        Number of threads torch uses in each worker. Fixed, so the neural network results do not 
+        depend on the number of workers.
+    log_file : string (optional)
+        Path to the replication log. Uses the seed of the log if it exists, which must have been 
+        written by the same test with the same classifier options, data (see data_fingerprint) 
+        and number of replications.
+    precomputed_kernels : bool (optional), default = False
+        Whether the SVMs are fit on sub-blocks of kernel matrices computed once for the whole test, 
+        instead of evaluating the kernel in every split. The trade-off is that the features are 
+        standardized with a scaler fit on all rows, rather than on the training rows of each split. 
+        The matrices are memory mapped from temporary files shared by all workers.
+    knn_index : bool (optional), default = False
+        Whether KNN finds neighbors in a neighbor index of all rows built once for the whole test 
+        (see utils.NeighborIndex), instead of a new search in every split. The features are standardized
+        with a scaler fit on all rows, as with precomputed_kernels.
+    nn_replicas : int (optional)
+        Number of consecutive replications whose neural networks are trained together as one 
+        utils.NetEnsemble (see run_ensemble), instead of one Net per replication. Only used with 
+        num_workers=1; worker processes always train one Net per replication. The networks use 
+        different random states than one Net per replication, so the results depend on this option.
+
+    Returns
+    -------
+    results : python dictionary
+        Dictionary that contains all the results. The results of the test are arrays: the test rows 
+        of each rep ("Test Rows", reps x rows), the predictions ("Preds", classifiers x reps x rows, 
+        -1 outside the test rows), the specimen votes ("Votes", classifiers x reps x specimens, -1 for 
+        specimens not in the test set) and the voting accuracy ("Accuracy", reps x classifiers).
+    """
+
+    if results is None:
+        results = {}
+    specimens = np.asarray(specimens)
+    clf_name = list(classifier_names)
+    fingerprint = data_fingerprint(data, target, specimens)
+    if nn_replicas is not None and nn_replicas < 1:
+        raise ValueError("nn_replicas must be at least 1")
+    nn_replicas = nn_replicas if num_workers == 1 else None
+    
+    # Resume from the log
+    header, logged = (None, {}) if log_file is None else read_log(log_file)
+    if header is not None:
+        if header["Test"] != dataset_level+desc or header["Classifiers"] != clf_name:
+            raise ValueError("Log file %s is for a different test"%log_file)
+        if seed is not None and np.random.SeedSequence(seed).entropy != header["Seed"]:
+            raise ValueError("Log file %s has a different seed"%log_file)
+        # Logs written before these options existed ran without them
+        if header.get("Precomputed Kernels", False) != bool(precomputed_kernels) or header.get("KNN Index", False) != bool(knn_index) \
+           or header.get("NN Replicas") != nn_replicas:
+            raise ValueError("Log file %s was run with different classifier options"%log_file)
+        if header.get("Data") != fingerprint or header.get("Reps") != reps:
+            raise ValueError("Log file %s was run with different data or number of replications"%log_file)
+        seed = header["Seed"]
+    seed_seq = np.random.SeedSequence(seed)
+    vote_seed, *seeds = seed_seq.spawn(reps+1)
+    
+    if log_file is not None:
+        log = open(log_file, 'ab')
+        if header is None:
+            append_log(log, {"Test": dataset_level+desc, "Seed": seed_seq.entropy, "Classifiers": clf_name, 
+                             "Precomputed Kernels": bool(precomputed_kernels), "KNN Index": bool(knn_index), 
+                             "NN Replicas": nn_replicas, "Data": fingerprint, "Reps": reps})
+    
+    # Results are stored in arrays over (classifiers x reps x rows), with -1 for rows not in the test set
+    specimen_names, codes = np.unique(specimens, return_inverse=True)
+    codes = codes.reshape(-1)
+    test_rows = np.zeros((reps, len(target)), dtype=bool)
+    preds = np.full((len(clf_name), reps, len(target)), -1, dtype=np.int8)
+    
+    iter_description = "Test: " + dataset_level+desc + ". Reps"
+    todo = [seeds[i] for i in range(reps) if i not in logged]
+    
+    # Kernel matrices of the SVMs and neighbor index, for all rows
+    kernel_files, kernel_dir, knn = None, None, None
+    if (precomputed_kernels or knn_index) and len(todo) > 0:
+        scaled_data = StandardScaler().fit_transform(data)
+    if knn_index and len(todo) > 0:
+        knn = utils.NeighborIndex(scaled_data, n_neighbors=25)
+    if precomputed_kernels and len(todo) > 0:
+        kernel_dir = tempfile.mkdtemp()
+        kernel_files = {"SVM - Linear": os.path.join(kernel_dir, "linear.npy"), "SVM - RBF": os.path.join(kernel_dir, "rbf.npy")}
+        for name, kernel in [("SVM - Linear", "linear"), ("SVM - RBF", "rbf")]:
+            utils.kernel_matrix(scaled_data, kernel, fname=kernel_files[name])
+    
+    if num_workers > 1 and len(todo) > 0:
+        pool = Pool(num_workers, initializer=init_worker, initargs=(data, target, specimens, torch_threads, kernel_files, knn, False))
+        rep_results = pool.imap(run_rep, todo)
+    else:
+        init_worker(data, target, specimens, torch_threads, kernel_files, knn, True, nn_replicas is not None)
+        rep_results = map(run_rep, todo)
+    nn_index = clf_name.index("Neural Network")
+    
+    try:
+        for i in tqdm(range(reps), desc=iter_description):
+            # Neural networks of the next block of replications, trained together
+            if nn_replicas is not None and i % nn_replicas == 0:
+                block = range(i, min(i+nn_replicas, reps))
+                if any(j not in logged for j in block):
+                    block_preds = run_ensemble([seeds[j] for j in block])
+            if i in logged:
+                test = np.array(logged[i]["test"], dtype=int)
+                rep_preds = np.array([logged[i]["preds"][name] for name in clf_name], dtype=np.int8).reshape((len(clf_name), len(test)))
+            else:
+                test, rep_preds = next(rep_results)
+                if nn_replicas is not None:
+                    rep_preds[nn_index] = block_preds[i % nn_replicas, test]
+                if log_file is not None:
+                    append_log(log, {"rep": i, "test": test.tolist(), "preds": dict(zip(clf_name, rep_preds.tolist()))})
+            test_rows[i, test] = True
+            preds[:, i, test] = rep_preds
+    finally:
+        if num_workers > 1 and len(todo) > 0:
+            pool.close()
+            pool.join()
+        if log_file is not None:
+            log.close()
+        if kernel_dir is not None:
+            shutil.rmtree(kernel_dir)
+    
+    # Vote within specimens, with one call per classifier, and the accuracy of each rep
+    last = len(specimens) - 1 - np.unique(specimens[::-1], return_index=True)[1]
+    specimen_targets = target[last]
+    num_classes = np.max(target)+1
+    vote_rng = np.random.default_rng(vote_seed)
+    votes = np.stack([utils.majority_vote(codes, pred, len(specimen_names), num_classes, rng=vote_rng) for pred in preds]).astype(np.int8)
+    present = votes[0] >= 0
+    accuracy = (np.sum((votes == specimen_targets) & present, axis=2) / np.sum(present, axis=1)).T
     
-    results[r["Test"]] = r
+    results[dataset_level+desc] = {"Test": dataset_level+desc, "dataset": dataset_level, "reps": reps, "Seed": seed_seq.entropy, 
+                                   "Classifiers": clf_name, "Specimens": specimen_names, "Codes": codes, "Targets": target, 
+                                   "Specimen Targets": specimen_targets, "Test Rows": test_rows, "Preds": preds, 
+                                   "Votes": votes, "Accuracy": accuracy}
     
     return results
 
+def confusion(truth, pred, num_classes):
+    """Confusion
+    ========
+
+    Confusion matrix and F1 score of predictions, from one bincount. Same as the sklearn 
+    confusion_matrix and f1_score functions.
+
+    Parameters
+    ----------
+    truth : numpy array (int)
+        True labels.
+    pred : numpy array (int)
+        Predicted labels.
+    num_classes : int
+        Number of classes.
+
+    Returns
+    -------
+    cm : numpy array (int)
+        Confusion matrix, over the labels that appear.
+    f1 : float
+        F1 score.
+    """
+    cm = np.bincount(truth.astype(int)*num_classes + pred, minlength=num_classes**2).reshape((num_classes,num_classes))
+    labels = np.flatnonzero(cm.sum(axis=0) + cm.sum(axis=1))
+    cm = cm[np.ix_(labels,labels)]
+    
+    # F1 score from the distinct (truth, prediction) pairs, weighted by their counts
+    i, j = np.nonzero(cm)
+    f1 = f1_score(labels[i], labels[j], sample_weight=cm[i,j])
+    return cm, f1
+
 def compile_results(results):
     """Compile Results
     ========
@@ -229,127 +633,79 @@ def compile_results(results):
     results : python dictionary
         Dictionary that now contains everything, plus outputable lists.
     """
-    # Summary and iter acc
     for test in results.keys():
-        test_name = results[test]["Test"]
-        reps = results[test]["reps"]
+        r = results[test]
+        test_name = r["Test"]
+        reps = r["reps"]
+        algos = r["Classifiers"]
+        num_specimens = len(r["Specimens"])
+        num_classes = max(np.max(r["Targets"]), np.max(r["Preds"]))+1
         
-        # Component Confusion matrices & f1 scores
-        target_truth = results[test]["Truth Targets"]
-        for algo in results[test]["Results"].keys():
-            component_cm = confusion_matrix(target_truth, results[test]["Results"][algo]["iter pred"])
-            results[test]["Results"][algo]["Component CM"] = component_cm
-            
-            component_f1 = f1_score(target_truth,results[test]["Results"][algo]["iter pred"])
-            results[test]["Results"][algo]["Component F1"] = component_f1
+        # Truth and specimen of every test row of every rep
+        test_rows = r["Test Rows"]
+        row_truth = np.broadcast_to(r["Targets"], test_rows.shape)[test_rows]
+        row_codes = np.broadcast_to(r["Codes"], test_rows.shape)[test_rows]
+        present = r["Votes"][0] >= 0
+        vote_truth = np.broadcast_to(r["Specimen Targets"], present.shape)[present]
         
-        # Appearances
-        for algo in results[test]["Results"].keys():
-            for mesh in results[test]["Truth Frags"]:
-                results[test]["Components"][mesh][algo] = 0
-                results[test]["Count Frags"][mesh][algo] = 0
-            
-            # Components
-            for i, pred in enumerate(results[test]["Results"][algo]["iter pred"]):
-                mesh = results[test]["Truth Frags"][i]
-                truth = results[test]["Truth Targets"][i]
-                results[test]["Components"][mesh][algo] += 1 * (pred == truth)
-            
-            # Voting
-            vote_pred = []
-            vote_truth = []
-            for vote in results[test]["Results"][algo]["iter vote"]:
-                for mesh in vote["frags"].keys():
-                    guess = vote["frags"][mesh]["Guess"]
-                    truth = vote["frags"][mesh]["Truth"]
-                    results[test]["Count Frags"][mesh][algo] += 1 * (guess == truth)
-                    vote_pred.append(guess)
-                    vote_truth.append(truth)
-            
-            # Voting CM
-            vote_cm = confusion_matrix(vote_truth, vote_pred)
-            results[test]["Results"][algo]["Vote CM"] = vote_cm
-            
-            # Voting F1
-            vote_f1 = f1_score(vote_truth, vote_pred)
-            results[test]["Results"][algo]["Vote F1"] = vote_f1
+        # Appearances of each specimen: number of reps, and number of test rows
+        appearances = {"Count Frags": np.sum(present, axis=0), "Components": np.bincount(row_codes, minlength=num_specimens)}
+        correct = {"Count Frags": {}, "Components": {}}
+        
+        r["Results"] = {}
+        for ii, algo in enumerate(algos):
+            # Component confusion matrices & f1 scores
+            pred = r["Preds"][ii][test_rows]
+            r["Results"][algo] = {}
+            r["Results"][algo]["Component CM"], r["Results"][algo]["Component F1"] = confusion(row_truth, pred, num_classes)
+            correct["Components"][algo] = np.bincount(row_codes[pred == row_truth], minlength=num_specimens)
             
-        # Confusion Matrices Again
+            # Voting confusion matrices & f1 scores
+            vote_pred = r["Votes"][ii][present]
+            r["Results"][algo]["Vote CM"], r["Results"][algo]["Vote F1"] = confusion(vote_truth, vote_pred, num_classes)
+            correct["Count Frags"][algo] = np.sum(r["Votes"][ii] == r["Specimen Targets"], axis=0)
             
+        # Confusion Matrices
         saved_component_cm = [["Test:", test_name, "Component CM", "Reps:", reps]]
         saved_component_cm.append(["Algorithm", "Confusion Matrix"])
         
         saved_vote_cm = [["Test:", test_name, "Vote CM", "Reps:", reps]]
         saved_vote_cm.append(["Algorithm", "Confusion Matrix"])
         
-        for algo in results[test]["Results"].keys():
-            name = algo
-            
-            cm = results[test]["Results"][algo]["Component CM"]
-            saved_component_cm.append([name])
-            saved_component_cm.extend(cm)
+        for algo in algos:
+            saved_component_cm.append([algo])
+            saved_component_cm.extend(r["Results"][algo]["Component CM"])
             saved_component_cm.append([]) # Spacer
             
-            cm = results[test]["Results"][algo]["Vote CM"]
-            saved_vote_cm.append([name])
-            saved_vote_cm.extend(cm)
+            saved_vote_cm.append([algo])
+            saved_vote_cm.extend(r["Results"][algo]["Vote CM"])
             saved_vote_cm.append([]) # Spacer
             
-        results[test]["Saved Component CM"] = saved_component_cm
-        results[test]["Saved Vote CM"] = saved_vote_cm
-        
-        # Appearances Again
-        component_apperences = [["Test:", test_name, "Component Appearances", "Reps:", reps]]
-        vote_apperences = [["Test:", test_name, "Vote Appearances", "Reps:", reps]]
-        algos = [*results[test]["Results"].keys()]
-        header = algos.copy()
-        header.insert(0, "Appearences")
-        header.insert(0, "Specimen")
-        component_apperences.append(header)
-        vote_apperences.append(header)
-        algos.insert(0, "Appearences")
+        r["Saved Component CM"] = saved_component_cm
+        r["Saved Vote CM"] = saved_vote_cm
         
-        for mesh in results[test]["Specimens"]:
-            component_inner_ls = [mesh]
-            vote_inner_ls = [mesh]
-            for algo in algos:
-                component_inner_ls.append(results[test]["Components"][mesh][algo])
-                vote_inner_ls.append(results[test]["Count Frags"][mesh][algo])
-            component_apperences.append(component_inner_ls)
-            vote_apperences.append(vote_inner_ls)
-        
-        results[test]["Saved Components"] = component_apperences
-        results[test]["Saved Votes"] = vote_apperences
-    
+        # Appearances, and correct predictions of each specimen
+        header = ["Specimen", "Appearences"] + algos
+        for key, saved in [("Components", "Saved Components"), ("Count Frags", "Saved Votes")]:
+            description = "Component Appearances" if key == "Components" else "Vote Appearances"
+            table = np.column_stack([appearances[key]] + [correct[key][algo] for algo in algos])
+            r[saved] = [["Test:", test_name, description, "Reps:", reps], header]
+            r[saved] += [[mesh] + row for mesh, row in zip(r["Specimens"], table.tolist())]
+    
+        # Summary
         save_sum_ls = [["Test:", test_name, "Summary Stats", "Reps:", reps]]
         save_sum_ls.append(["Algorithm", "Mean Accuracy", "Standard Deviation", "F1 Score", "Component F1 Score"])
-        for algo in results[test]["Results"].keys():
-            inner_ls = []
-            for vote in results[test]["Results"][algo]["iter vote"]:
-                inner_ls.append(vote["Mean Accuracy"])
-            results[test]["Results"][algo]["saved iter acc"] = inner_ls
-            save_sum_ls.append([algo, 100 * np.mean(inner_ls), 100 * np.std(inner_ls), results[test]["Results"][algo]["Vote F1"], results[test]["Results"][algo]["Component F1"]])
-        results[test]["Summary Acc"] = save_sum_ls
+        for ii, algo in enumerate(algos):
+            acc = r["Accuracy"][:,ii]
+            save_sum_ls.append([algo, 100 * np.mean(acc), 100 * np.std(acc), r["Results"][algo]["Vote F1"], r["Results"][algo]["Component F1"]])
+        r["Summary Acc"] = save_sum_ls
         
         # Iter Acc
         save_iter_ls = [["Test:", test_name, "Iter Accuracy", "Reps:", reps]]
-        save_iter_ls.append([*results[test]["Results"].keys()])
-        names_inner_ls = []
-        iter_inner_ls = []
-        for algo in results[test]["Results"].keys():
-            names_inner_ls.append(algo)
-            iter_inner_ls.append(results[test]["Results"][algo]["saved iter acc"])
-        
-        save_iter_ls.append(names_inner_ls)
-        
-        # There are better ways to reshape these lists
-        for i in range(reps):
-            inner_ls = []
-            for ii in range(len(iter_inner_ls)):
-                inner_ls.append(iter_inner_ls[ii][i])
-            save_iter_ls.append(inner_ls)
-        
-        results[test]["Iter Algo Acc"] = save_iter_ls
+        save_iter_ls.append(list(algos))
+        save_iter_ls.append(list(algos))
+        save_iter_ls.extend(r["Accuracy"].tolist())
+        r["Iter Algo Acc"] = save_iter_ls
     
     return results
 
@@ -442,7 +798,12 @@ def save_results(results):
                 writer = csv.writer(csvfile)
                 writer.writerows(results[test_name]["Saved Components"])
                 
-def main():
+def main(num_workers=None, log_dir="../results/rep_logs/", nn_replicas=10):
+    # On a GPU host the tests run in this process, with the neural networks trained in blocks of 
+    # nn_replicas replications on the GPU. Otherwise they run in one worker process per core.
+    if num_workers is None:
+        num_workers = 1 if torch.cuda.is_available() else os.cpu_count()
+    
     # Main Break Test
     break_test = {"dataset": "breaks", "target_field": "Effector", "desc": "","numerical_fields" : None, "categorical_fields" : None, "sum_stats_fields" : None, "sum_stats" : None, "count_fields" : None}
     
@@ -466,15 +827,21 @@ def main():
     # Test compilation
     tests = [break_test, frag_test]
     
-    # Iterating over the tests
+    # Iterating over the tests. Finished replications are logged, so an interrupted run resumes where it stopped.
+    os.makedirs(log_dir, exist_ok=True)
+    log_files = [log_dir + test["dataset"] + test["desc"] + ".jsonl" for test in tests]
     results = {}
-    for test in tests:
+    for test, log_file in zip(tests, log_files):
         data, target, specimens = create_dataset(test)
-        results = run_test(data, target, specimens, test["dataset"], test["desc"])
+        results = run_test(data, target, specimens, test["dataset"], test["desc"], results, num_workers=num_workers, log_file=log_file, nn_replicas=nn_replicas)
         
     results = compile_results(results)
     
     save_results(results)
+    
+    # The next run starts over
+    for log_file in log_files:
+        os.remove(log_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+import utils
+
+def test_net_ensemble_matches_net():
+    """Replicas trained on different numbers of rows match standalone Nets trained on the same rows"""
+
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(100,5)).astype(np.float32)
+    target = rng.integers(0,3,size=100)
+
+    #Replicas with 100, 70, 45 and 9 rows, so the shorter ones sit out most batches
+    masks = np.zeros((4,100), dtype=bool)
+    for r,count in enumerate([100,70,45,9]):
+        masks[r,rng.choice(100,count,replace=False)] = True
+
+    ensemble = utils.NetEnsemble(num_replicas=4, structure=[5,8], num_classes=3, epochs=6, learning_rate=1, batch_size=16)
+    ensemble.fit(data, target, masks)
+
+    for r in range(4):
+        #Train a standalone Net from the initial weights of the replica (drawn by the reset in fit)
+        torch.manual_seed(0)
+        initial = utils.NetEnsemble(num_replicas=4, structure=[5,8], num_classes=3)
+        initial.reset()
+        state = {k: v.clone() for k,v in initial.replica(r).state_dict().items()}
+        net = utils.Net(structure=[5,8], num_classes=3, epochs=6, learning_rate=1, batch_size=16)
+        net.reset = lambda: net.load_state_dict(state)
+        net.fit(data[masks[r]], target[masks[r]])
+
+        trained = ensemble.replica(r)
+        for a,b in zip(net.state_dict().values(), trained.state_dict().values()):
+            assert torch.allclose(a, b, atol=1e-5)
+
+def test_net_ensemble_standardization():
+    """Replicas standardized with their own mean and scale match Nets trained on standardized rows"""
+
+    torch.manual_seed(0)
+    rng = np.random.default_rng(1)
+    data = rng.normal(loc=3, scale=2, size=(60,4)).astype(np.float32)
+    target = rng.integers(0,2,size=60)
+    masks = rng.random((3,60)) < 0.7
+    mean = np.stack([data[m].mean(axis=0) for m in masks])
+    scale = np.stack([data[m].std(axis=0) for m in masks])
+
+    ensemble = utils.NetEnsemble(num_replicas=3, structure=[4,6], num_classes=2, epochs=3, learning_rate=1, batch_size=8)
+    ensemble.fit(data, target, masks, mean, scale)
+    log_proba = ensemble.predict_log_proba(data, batch_size=25)
+
+    for r in range(3):
+        torch.manual_seed(0)
+        initial = utils.NetEnsemble(num_replicas=3, structure=[4,6], num_classes=2)
+        initial.reset()
+        state = {k: v.clone() for k,v in initial.replica(r).state_dict().items()}
+        net = utils.Net(structure=[4,6], num_classes=2, epochs=3, learning_rate=1, batch_size=8)
+        net.reset = lambda: net.load_state_dict(state)
+        scaled = (data - mean[r])/scale[r]
+        net.fit(scaled[masks[r]], target[masks[r]])
+
+        net.eval()
+        with torch.no_grad():
+            expected = net(torch.tensor(scaled)).numpy()
+        assert np.allclose(log_proba[r], expected, atol=1e-4)
@@ -7,10 +7,15 @@ import numpy as np
 import amaazetools.trimesh as tm
 from sklearn import preprocessing
 from sklearn.utils import shuffle
+from sklearn.neighbors import NearestNeighbors
 import pickle
 import matplotlib.pyplot as plt
 import os,sys
 import pandas as pd
+import json
+import hashlib
+import time
+from collections import OrderedDict
 
 break_level_fields_numerical = ['Count',
                                 'Mean',
@@ -65,12 +70,130 @@ frag_level_fields_numerical = ['Surface Area',
                                'Bounding Box Dim3']
 
 
-def break_level_ml_dataset(numerical_fields=None, categorical_fields=None, target_field='Effector'):
+#Directory for binary copies of the encoded machine learning datasets
+dataset_cache_dir = '../data/cache'
+
+#Number of encoded datasets to keep in memory
+dataset_memory_size = 16
+dataset_memory = OrderedDict()
+
+def cached_dataset(fname, selection, build, cache=True, copy=True):
+    """Cached Dataset
+    ========
+
+    Returns an encoded dataset from the in-memory cache, the binary cache on disk, or by building it.
+    Datasets are identified by the csv file (path, size and modification time) and the selection 
+    of fields, so editing the csv file invalidates the cache.
+    
+    Parameters
+    ----------
+    fname : string
+        Path to csv file.
+    selection : python dictionary
+        Fields and options used to build the dataset (must be json serializable).
+    build : function
+        Function with no arguments that builds the dataset, returning a dictionary of numpy arrays.
+    cache : bool (optional), default = True
+        Whether to use the caches. If False the dataset is always built.
+    copy : bool (optional), default = True
+        Whether to return copies of the arrays. Otherwise the cached arrays are returned, which are read-only.
+
+    Returns
+    -------
+    dataset : python dictionary
+        Dictionary of numpy arrays.
+    """
+
+    if not cache:
+        return build()
+
+    s = os.stat(fname)
+    key = json.dumps([os.path.abspath(fname), s.st_size, s.st_mtime_ns, selection])
+    key = hashlib.sha1(key.encode()).hexdigest()
+
+    if key in dataset_memory:
+        dataset_memory.move_to_end(key)
+    else:
+        cache_file = os.path.join(dataset_cache_dir, key + '.npz')
+        if os.path.isfile(cache_file):
+            with np.load(cache_file, allow_pickle=False) as f:
+                dataset = {k:f[k] for k in f.files}
+        else:
+            dataset = build()
+            os.makedirs(dataset_cache_dir, exist_ok=True)
+            with open(cache_file + '.tmp', 'wb') as f:
+                np.savez(f, **dataset)
+            os.replace(cache_file + '.tmp', cache_file)
+        for v in dataset.values():
+            v.setflags(write=False)
+        dataset_memory[key] = dataset
+        if len(dataset_memory) > dataset_memory_size:
+            dataset_memory.popitem(last=False)
+
+    if copy:
+        return {k:v.copy() for k,v in dataset_memory[key].items()}
+    return dict(dataset_memory[key])
+
+def encode_dataset(df, numerical_fields, categorical_fields, target_field):
+    """Encode Dataset
+    ========
+
+    Converts categorical fields to one-hot encodings, combines them with the numerical fields,
+    and encodes the target as integers.
+    
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data.
+    numerical_fields : list
+        List of numerical fields to use.
+    categorical_fields : list
+        List of categorical fields to use.
+    target_field : string
+        Field to use for target of machine learning.
+
+    Returns
+    -------
+    dataset : python dictionary
+        Contains 'data', 'target', 'target_names', 'specimens', 'feature_names' 
+        (names of the columns of data, where one-hot columns are named field_value),
+        'feature_fields' (field each column comes from) and 'feature_kinds' 
+        ('categorical' or 'numerical').
+    """
+
+    #Categorical Data
+    cat_data = df[categorical_fields]
+    le_cat = preprocessing.OneHotEncoder(sparse=False)
+    cat_data = le_cat.fit_transform(cat_data)
+    cat_names = [field + '_' + str(c) for field,cats in zip(categorical_fields,le_cat.categories_) for c in cats]
+
+    #Numerical data
+    num_data = df[numerical_fields].values
+
+    #Combine data
+    data = np.hstack((cat_data,num_data))
+
+    #Target
+    le = preprocessing.LabelEncoder()
+    target = le.fit_transform(df[target_field])
+    target_names = le.classes_
+
+    return {'data':data.astype(float),
+            'target':target,
+            'target_names':np.asarray(target_names, dtype=str),
+            'specimens':np.asarray(df['Specimen'], dtype=str),
+            'feature_names':np.array(cat_names + list(numerical_fields), dtype=str),
+            'feature_fields':np.array([field for field,cats in zip(categorical_fields,le_cat.categories_) for c in cats] + list(numerical_fields), dtype=str),
+            'feature_kinds':np.array(['categorical']*len(cat_names) + ['numerical']*len(numerical_fields), dtype=str)}
+
+def break_level_ml_dataset(numerical_fields=None, categorical_fields=None, target_field='Effector', cache=True):
     """Break Level Machine Learning Dataset
     ========
 
     Converts the break level data to numerical data via one-hot encodings and 
     returns a numerical dataset at the break-level for use in machine learning.
+    Encoded datasets are cached in memory and in dataset_cache_dir, so repeated
+    loads do not parse the csv file again.
     
     Parameters
     ----------
@@ -80,6 +203,8 @@ def break_level_ml_dataset(numerical_fields=None, categorical_fields=None, targe
         List of categorical fields to use. Uses all if not provided.
     target_field : string (optional), default = 'Effector'
         Field to use for target of machine learning.
+    cache : bool (optional), default = True
+        Whether to use cached copies of the dataset.
 
     Returns
     -------
@@ -96,42 +221,63 @@ def break_level_ml_dataset(numerical_fields=None, categorical_fields=None, targe
         
     """
 
-    if numerical_fields is None:
-        numerical_fields = break_level_fields_numerical
-    if categorical_fields is None:
-        categorical_fields = break_level_fields_categorial
+    fname, selection, build = break_level_source(numerical_fields, categorical_fields, target_field)
+    d = cached_dataset(fname, selection, build, cache=cache)
 
-    df = pd.read_csv('../data/break_level_ml.csv') 
+    return d['data'],d['target'],d['specimens'],d['break_numbers'],d['target_names']
 
-    #Categorical Data
-    cat_data = df[categorical_fields]
-    le = preprocessing.OneHotEncoder(sparse=False)
-    cat_data = le.fit_transform(cat_data)
+def break_level_source(numerical_fields=None, categorical_fields=None, target_field='Effector'):
+    """Break Level Source
+    ========
 
-    #Numerical data
-    num_data = df[numerical_fields].values
+    Describes how to build the encoded break level dataset for the given fields (see cached_dataset).
 
-    #Combine data
-    data = np.hstack((cat_data,num_data))
+    Parameters
+    ----------
+    numerical_fields : list (optional)
+        List of numerical fields to use. Uses all if not provided.
+    categorical_fields : list (optional)
+        List of categorical fields to use. Uses all if not provided.
+    target_field : string (optional), default = 'Effector'
+        Field to use for target of machine learning.
 
-    #Target
-    le = preprocessing.LabelEncoder()
-    target = le.fit_transform(df[target_field])
-    target_names = le.classes_
+    Returns
+    -------
+    fname : string
+        Path to csv file.
+    selection : python dictionary
+        Fields used, which identify the dataset in the cache.
+    build : function
+        Builds the encoded dataset.
+    """
 
-    #Specimen names and break numbers
-    specimens = df['Specimen'].values
-    break_numbers = df['BreakNo'].values
+    if numerical_fields is None:
+        numerical_fields = break_level_fields_numerical
+    if categorical_fields is None:
+        categorical_fields = break_level_fields_categorial
+    numerical_fields, categorical_fields = list(numerical_fields), list(categorical_fields)
 
-    return data,target,specimens,break_numbers,target_names
+    fname = '../data/break_level_ml.csv'
+    def build():
+        #Only read the columns that are needed
+        columns = list(dict.fromkeys(['Specimen','BreakNo',target_field] + categorical_fields + numerical_fields))
+        df = pd.read_csv(fname, usecols=columns, dtype={f:float for f in numerical_fields})
+        dataset = encode_dataset(df, numerical_fields, categorical_fields, target_field)
+        dataset['break_numbers'] = np.asarray(df['BreakNo'], dtype=int)
+        return dataset
+
+    selection = {'numerical_fields':numerical_fields, 'categorical_fields':categorical_fields, 'target_field':target_field}
+    return fname, selection, build
 
 def frag_level_ml_dataset(numerical_fields=None, categorical_fields=None, sum_stats_fields=None,
-                          sum_stats=None, count_fields=None, target_field='Effector'):
+                          sum_stats=None, count_fields=None, target_field='Effector', cache=True):
     """Fragment Level Machine Learning Dataset
     ========
 
     Converts the fragment level data to numerical data via one-hot encodings and 
     returns a numerical dataset at the fragment-level for use in machine learning.
+    Encoded datasets are cached in memory and in dataset_cache_dir, so repeated
+    loads do not parse the csv file again.
     
     Parameters
     ----------
@@ -147,6 +293,8 @@ def frag_level_ml_dataset(numerical_fields=None, categorical_fields=None, sum_st
         List of categorical counting fields.
     target_field : string (optional), default = 'Effector'
         Field to use for target of machine learning.
+    cache : bool (optional), default = True
+        Whether to use cached copies of the dataset.
 
     Returns
     -------
@@ -160,6 +308,43 @@ def frag_level_ml_dataset(numerical_fields=None, categorical_fields=None, sum_st
         List of target names.
     """
 
+    fname, selection, build = frag_level_source(numerical_fields, categorical_fields, sum_stats_fields, sum_stats, count_fields, target_field)
+    d = cached_dataset(fname, selection, build, cache=cache)
+
+    return d['data'],d['target'],d['specimens'],d['target_names']
+
+def frag_level_source(numerical_fields=None, categorical_fields=None, sum_stats_fields=None,
+                      sum_stats=None, count_fields=None, target_field='Effector'):
+    """Fragment Level Source
+    ========
+
+    Describes how to build the encoded fragment level dataset for the given fields (see cached_dataset).
+
+    Parameters
+    ----------
+    numerical_fields : list (optional)
+        List of numerical fields to use. Uses all if not provided.
+    categorical_fields : list (optional)
+        List of categorical fields to use. Uses all if not provided.
+    sum_stats_fields : list (optional)
+        List of summary statistics fields to use. Uses all if not provided.
+    sum_stats : list (optional)
+        Summary statistics to use. Uses all if not provided.
+    count_fields : list (optional)
+        List of categorical counting fields.
+    target_field : string (optional), default = 'Effector'
+        Field to use for target of machine learning.
+
+    Returns
+    -------
+    fname : string
+        Path to csv file.
+    selection : python dictionary
+        Fields used, which identify the dataset in the cache.
+    build : function
+        Builds the encoded dataset.
+    """
+
     if numerical_fields is None:
         numerical_fields = frag_level_fields_numerical
     if categorical_fields is None:
@@ -171,46 +356,190 @@ def frag_level_ml_dataset(numerical_fields=None, categorical_fields=None, sum_st
     if count_fields is None:
         count_fields = frag_level_count_fields
 
-    df = pd.read_csv('../data/frag_level_ml.csv') 
+    #Copy the field lists, so the module level defaults are not modified below
+    numerical_fields, categorical_fields = list(numerical_fields), list(categorical_fields)
+    sum_stats_fields, sum_stats, count_fields = list(sum_stats_fields), list(sum_stats), list(count_fields)
 
-    #Categorical Data
-    cat_data = df[categorical_fields]
-    le = preprocessing.OneHotEncoder(sparse=False)
-    cat_data = le.fit_transform(cat_data)
-
-    #Add all summary statistics fields
-    for field in sum_stats_fields:
-        for stat in sum_stats:
-            numerical_fields += [field + '_' + stat]
-
-    #Add all count fields
-    for field in count_fields:
-        for c in df.columns:
-            if c.startswith(field):
-                numerical_fields += [c]
-                    
-    #Numerical data
-    num_data = df[numerical_fields].values
+    fname = '../data/frag_level_ml.csv'
+    def build():
+        columns = pd.read_csv(fname, nrows=0).columns
 
-    #Combine data
-    data = np.hstack((cat_data,num_data))
+        #Columns to use, with the field and kind of field each one comes from
+        fields = list(numerical_fields)
+        sources = list(numerical_fields)
+        kinds = ['numerical']*len(numerical_fields)
 
-    #Target
-    le = preprocessing.LabelEncoder()
-    target = le.fit_transform(df[target_field])
-    target_names = le.classes_
+        #Add all summary statistics fields
+        for field in sum_stats_fields:
+            for stat in sum_stats:
+                fields += [field + '_' + stat]
+                sources += [field]
+                kinds += ['sum_stats']
+
+        #Add all count fields
+        for field in count_fields:
+            for c in columns:
+                if c.startswith(field):
+                    fields += [c]
+                    sources += [field]
+                    kinds += ['count']
+
+        #Only read the columns that are needed
+        usecols = list(dict.fromkeys(['Specimen',target_field] + categorical_fields + fields))
+        df = pd.read_csv(fname, usecols=usecols, dtype={f:float for f in fields})
+        dataset = encode_dataset(df, fields, categorical_fields, target_field)
 
-    #Specimen names and break numbers
-    specimens = df['Specimen'].values
+        num_cat = len(dataset['feature_names']) - len(fields)
+        dataset['feature_fields'] = np.hstack((dataset['feature_fields'][:num_cat], np.array(sources, dtype=str)))
+        dataset['feature_kinds'] = np.hstack((dataset['feature_kinds'][:num_cat], np.array(kinds, dtype=str)))
+        return dataset
 
-    return data,target,specimens,target_names
+    selection = {'numerical_fields':numerical_fields, 'categorical_fields':categorical_fields, 'sum_stats_fields':sum_stats_fields,
+                 'sum_stats':sum_stats, 'count_fields':count_fields, 'target_field':target_field}
+    return fname, selection, build
 
 
+class FeatureSpec:
+    def __init__(self, dataset='frags', numerical_fields=None, categorical_fields=None, sum_stats_fields=None,
+                 sum_stats=None, count_fields=None, target_field='Effector'):
+        """Feature Specification
+        ========
+
+        Selection of features for a machine learning dataset, resolved to column indices of a single
+        master dataset that contains every default field. All selections of the same dataset share one
+        load and encoding of the csv file, and each selection is a gather (or view) of the master data,
+        which makes ablation studies over many subsets of features cheap. The result is the same as
+        break_level_ml_dataset or frag_level_ml_dataset with the same fields.
         
+        Parameters
+        ----------
+        dataset : string (optional), default = 'frags'
+            Either 'breaks' or 'frags'.
+        numerical_fields : list (optional)
+            List of numerical fields to use. Uses all if not provided.
+        categorical_fields : list (optional)
+            List of categorical fields to use. Uses all if not provided.
+        sum_stats_fields : list (optional)
+            List of summary statistics fields to use (frags only). Uses all if not provided.
+        sum_stats : list (optional)
+            Summary statistics to use (frags only). Uses all if not provided.
+        count_fields : list (optional)
+            List of categorical counting fields (frags only). Uses all if not provided.
+        target_field : string (optional), default = 'Effector'
+            Field to use for target of machine learning.
+        """
+
+        if dataset == 'breaks':
+            defaults = [break_level_fields_numerical, break_level_fields_categorial, [], [], []]
+        elif dataset == 'frags':
+            defaults = [frag_level_fields_numerical, frag_level_fields_categorical, frag_level_sum_stats_fields,
+                        frag_level_sum_stats, frag_level_count_fields]
+        else:
+            raise ValueError("dataset must be 'breaks' or 'frags'")
+        fields = [numerical_fields, categorical_fields, sum_stats_fields, sum_stats, count_fields]
+        fields = [list(d) if f is None else list(f) for f,d in zip(fields,defaults)]
+        if dataset == 'breaks':
+            fields[2:] = [[], [], []]
+
+        self.dataset = dataset
+        self.numerical_fields, self.categorical_fields, self.sum_stats_fields, self.sum_stats, self.count_fields = fields
+        self.target_field = target_field
+        self.idx = None
+
+    def master(self, cache=True):
+        """Master
+        ========
+
+        Loads the master dataset, with all default fields, from the dataset cache.
+        
+        Parameters
+        ----------
+        cache : bool (optional), default = True
+            Whether to use cached copies of the dataset.
+
+        Returns
+        -------
+        dataset : python dictionary
+            Encoded dataset (see encode_dataset). The arrays are read-only.
+        """
+        if self.dataset == 'breaks':
+            fname, selection, build = break_level_source(target_field=self.target_field)
+        else:
+            fname, selection, build = frag_level_source(target_field=self.target_field)
+        return cached_dataset(fname, selection, build, cache=cache, copy=False)
+
+    def columns(self, master):
+        """Columns
+        ========
+
+        Resolves the selected fields to column indices of the master dataset, in the same 
+        order as break_level_ml_dataset and frag_level_ml_dataset.
+        
+        Parameters
+        ----------
+        master : python dictionary
+            Master dataset from the master method.
+
+        Returns
+        -------
+        idx : numpy array (int)
+            Indices of the selected columns.
+        """
+        names, fields, kinds = master['feature_names'], master['feature_fields'], master['feature_kinds']
+        find = lambda mask, desc: np.flatnonzero(mask) if np.any(mask) else self._missing(desc)
+
+        idx = [np.zeros(0,dtype=int)]
+        for field in self.categorical_fields:
+            idx += [find((kinds == 'categorical') & (fields == field), field)]
+        for field in self.numerical_fields:
+            idx += [find((kinds == 'numerical') & (names == field), field)]
+        for field in self.sum_stats_fields:
+            for stat in self.sum_stats:
+                idx += [find((kinds == 'sum_stats') & (names == field + '_' + stat), field + '_' + stat)]
+        for field in self.count_fields:
+            idx += [find((kinds == 'count') & (fields == field), field)]
+        return np.hstack(idx)
+
+    def _missing(self, field):
+        raise ValueError("Field '%s' is not in the master %s dataset"%(field,self.dataset))
+
+    def load(self, cache=True):
+        """Load
+        ========
+
+        Returns the selected features from the master dataset. When the selected columns are 
+        contiguous the data is a read-only view of the master data, otherwise it is a copy.
+        
+        Parameters
+        ----------
+        cache : bool (optional), default = True
+            Whether to use cached copies of the dataset.
+
+        Returns
+        -------
+        data : numpy array (float)
+            Features.
+        target : numpy array (int)
+            Targets as integers
+        specimens : numpy array (string)
+            List of specimen names.
+        """
+        master = self.master(cache=cache)
+        if self.idx is None:
+            self.idx = self.columns(master)
+
+        idx = self.idx
+        if len(idx) > 0 and np.all(np.diff(idx) == 1):
+            data = master['data'][:,idx[0]:idx[-1]+1]
+        else:
+            data = master['data'][:,idx]
+        return data, master['target'], master['specimens']
+
 
 class Net(nn.Module):
     def __init__(self, structure=[10,10], num_classes=2, dropout_rate=0.0, batch_normalization=False,
-                 epochs=100, cuda=False, learning_rate=0.1,batch_size=32, gamma=0.9, verbose=False):
+                 epochs=100, cuda=False, learning_rate=0.1,batch_size=32, gamma=0.9, verbose=False,
+                 shuffle=False, validation_fraction=0.0, patience=10, num_threads=None, compile_forward=False, epoch_callback=None, precision='float32'):
         """Neural Network Classifier
         ========
 
@@ -240,6 +569,25 @@ class Net(nn.Module):
             Scheduler parameter. How much to decrease learning rate at each iteration.
         verbose : bool (optional), default = False
             Whether to print out details during training or not.
+        shuffle : bool (optional), default = False
+            Whether to visit the training data in a new random order every epoch. The data is permuted 
+            once per epoch into a preallocated tensor, and the mini-batches are views of it.
+        validation_fraction : float (optional), default = 0.0
+            Fraction of the training data held out for early stopping. No early stopping if zero.
+        patience : int (optional), default = 10
+            Number of epochs without improvement of the validation loss before training stops.
+            The weights with the best validation loss are restored.
+        num_threads : int (optional)
+            Number of CPU threads used by torch during training. Uses the torch setting if not provided.
+        compile_forward : bool (optional), default = False
+            Whether to compile the forward and backward passes with torch.compile. The compiled graph is
+            reused by later fits, so this pays off when the network is trained many times.
+        epoch_callback : function (optional)
+            Called after every epoch as epoch_callback(epoch, seconds, train_loss, val_loss), for example
+            to time training. val_loss is None without early stopping.
+        precision : string (optional), default = 'float32'
+            Either 'float32' or 'bfloat16'. With 'bfloat16' training and prediction run under bfloat16 
+            autocast, which is faster on CPUs with native bfloat16 support. See also quantize and parity_check.
         """
 
         super(Net, self).__init__()
@@ -254,6 +602,15 @@ class Net(nn.Module):
         self.batch_size = batch_size
         self.gamma = gamma
         self.verbose = verbose
+        self.shuffle = shuffle
+        self.validation_fraction = validation_fraction
+        self.patience = patience
+        self.num_threads = num_threads
+        self.compile_forward = compile_forward
+        self.epoch_callback = epoch_callback
+        self.precision = precision
+        self.compiled_forward = None
+        self.epoch_times = []
 
         self.num_layers = len(structure)-1
         self.fc = nn.ModuleList()
@@ -275,7 +632,14 @@ class Net(nn.Module):
                 'learning_rate':self.learning_rate,
                 'batch_size':self.batch_size,
                 'gamma':self.gamma,
-                'verbose':self.verbose}
+                'verbose':self.verbose,
+                'shuffle':self.shuffle,
+                'validation_fraction':self.validation_fraction,
+                'patience':self.patience,
+                'num_threads':self.num_threads,
+                'compile_forward':self.compile_forward,
+                'epoch_callback':self.epoch_callback,
+                'precision':self.precision}
 
     def __str__(self):
         s =  'NeuralNetwork('
@@ -289,6 +653,12 @@ class Net(nn.Module):
         s += ',batch_size=%d'%self.batch_size
         s += ',gamma='+str(self.gamma)
         s += ',verbose='+str(self.verbose)
+        s += ',shuffle='+str(self.shuffle)
+        s += ',validation_fraction='+str(self.validation_fraction)
+        s += ',patience=%d'%self.patience
+        s += ',num_threads='+str(self.num_threads)
+        s += ',compile_forward='+str(self.compile_forward)
+        s += ',precision='+self.precision
         s += ')'
         return s
 
@@ -331,10 +701,6 @@ class Net(nn.Module):
         #Reset weights
         self.reset()
 
-        #Convert to torch
-        data = torch.from_numpy(data).float()
-        target = torch.from_numpy(target).long()
-
         #Cuda (GPU)
         use_cuda = self.cuda and torch.cuda.is_available()
         if self.verbose:
@@ -345,46 +711,149 @@ class Net(nn.Module):
         device = torch.device("cuda" if use_cuda else "cpu")
         self.to(device)
 
+        #Convert to contiguous torch tensors on the device once
+        data = torch.tensor(np.asarray(data), dtype=torch.float32, device=device)
+        target = torch.tensor(np.asarray(target), dtype=torch.long, device=device)
+
+        #Hold out validation data for early stopping
+        early_stopping = self.validation_fraction > 0
+        if early_stopping:
+            perm = torch.randperm(len(data), device=device)
+            num_val = max(1, int(self.validation_fraction*len(data)))
+            val_data, val_target = data[perm[:num_val]], target[perm[:num_val]]
+            data, target = data[perm[num_val:]], target[perm[num_val:]]
+
+        #Threads and compiled forward pass
+        num_threads = torch.get_num_threads()
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        forward = self.forward
+        if self.compile_forward:
+            if self.compiled_forward is None:
+                self.compiled_forward = torch.compile(self.forward, dynamic=True)
+            forward = self.compiled_forward
+
         #Optimizer and scheduler
         optimizer = optim.Adadelta(self.parameters(), lr=self.learning_rate)
         scheduler = StepLR(optimizer, step_size=1, gamma=self.gamma)
 
-        for epoch in range(1, self.epochs + 1):
-            if self.verbose:
-                print('\nEpoch: %d'%epoch)
-            self.train_epoch(device, data, target, optimizer, epoch, self.batch_size, self.verbose)
-            scheduler.step()
+        #Buffers for the shuffled data
+        if self.shuffle:
+            buffers = (torch.empty_like(data), torch.empty_like(target))
+
+        best_loss, best_state, bad_epochs = np.inf, None, 0
+        self.epoch_times = []
+        try:
+            for epoch in range(1, self.epochs + 1):
+                if self.verbose:
+                    print('\nEpoch: %d'%epoch)
+                start = time.perf_counter()
+
+                if self.shuffle:
+                    perm = torch.randperm(len(data), device=device)
+                    torch.index_select(data, 0, perm, out=buffers[0])
+                    torch.index_select(target, 0, perm, out=buffers[1])
+                    train_loss = self.train_epoch(device, buffers[0], buffers[1], optimizer, epoch, self.batch_size, self.verbose, forward)
+                else:
+                    train_loss = self.train_epoch(device, data, target, optimizer, epoch, self.batch_size, self.verbose, forward)
+                scheduler.step()
+
+                #Early stopping on validation loss
+                val_loss = None
+                if early_stopping:
+                    self.eval()
+                    with torch.no_grad(), self.autocast(device):
+                        val_loss = F.nll_loss(forward(val_data), val_target).item()
+                    if val_loss < best_loss:
+                        best_loss, bad_epochs = val_loss, 0
+                        best_state = {k:v.detach().clone() for k,v in self.state_dict().items()}
+                    else:
+                        bad_epochs += 1
 
-    def train_epoch(self, device, data, target, optimizer, epoch, batch_size, verbose):
+                seconds = time.perf_counter() - start
+                self.epoch_times.append(seconds)
+                if self.epoch_callback is not None:
+                    self.epoch_callback(epoch, seconds, train_loss, val_loss)
+                if early_stopping and bad_epochs >= self.patience:
+                    break
+        finally:
+            torch.set_num_threads(num_threads)
+
+        if best_state is not None:
+            self.load_state_dict(best_state)
+
+    def train_epoch(self, device, data, target, optimizer, epoch, batch_size, verbose, forward=None):
+        """Train Epoch
+        ========
+
+        Trains the neural network for one epoch, on consecutive mini-batches of the data.
+        
+        Parameters
+        ----------
+        device : torch device
+            Device to train on.
+        data : torch tensor (float)
+            Features.
+        target : torch tensor (int)
+            Labels.
+        optimizer : torch optimizer
+            Optimizer.
+        epoch : int
+            Epoch number, for printing.
+        batch_size : int
+            Size of mini-batches.
+        verbose : bool
+            Whether to print out details during training or not.
+        forward : function (optional)
+            Forward pass to use, e.g., a compiled one. Uses self.forward if not provided.
+
+        Returns
+        -------
+        loss : float
+            Mean training loss over the mini-batches.
+        """
+
+        if forward is None:
+            forward = self.forward
 
         self.train()
         batch_idx = 0
+        total_loss = torch.zeros((), device=device)
         for idx in range(0,len(data),batch_size):
 
             data_batch, target_batch = data[idx:idx+batch_size], target[idx:idx+batch_size]
             data_batch, target_batch = data_batch.to(device), target_batch.to(device)
 
             optimizer.zero_grad()
-            output = self.forward(data_batch)
-            loss = F.nll_loss(output, target_batch)
+            with self.autocast(device):
+                output = forward(data_batch)
+                loss = F.nll_loss(output, target_batch)
             loss.backward()
             optimizer.step()
+            total_loss += loss.detach()
             if verbose:
                 print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                     epoch, batch_idx * len(data_batch), len(target),
                     100. * batch_idx / int(len(data)/batch_size), loss.item()))
             batch_idx += 1
 
-    def predict(self, data):
+        return total_loss.item()/max(batch_idx,1)
+
+    def predict(self, data, batch_size=10000, out=None):
         """Predict
         ========
 
-        Predict labels using trained neural network.
+        Predict labels using trained neural network. The data is processed in chunks, so memory
+        use is bounded for large (e.g., memory mapped) inputs.
         
         Parameters
         ----------
         data : numpy array (float)
-            Features
+            Features, which can be memory mapped.
+        batch_size : int (optional), default = 10000
+            Number of rows processed at once.
+        out : numpy array (int) (optional)
+            Preallocated array for the labels.
 
         Returns
         -------
@@ -392,21 +861,675 @@ class Net(nn.Module):
             Predicted labels.
         """
 
-        data = torch.from_numpy(data).float()
-        self.to(torch.device("cpu"))
+        labels = np.empty(len(data), dtype=int) if out is None else out
+        for i,output in self.forward_chunks(data, batch_size):
+            labels[i:i+len(output)] = torch.argmax(output, dim=1).cpu().numpy()
+        return labels
+
+    def log_proba(self, data, precision=None, batch_size=10000, out=None):
+        """Log Probabilities
+        ========
+
+        Log-probabilities of each class from the trained neural network, computed in chunks.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features, which can be memory mapped.
+        precision : string (optional)
+            Either 'float32' or 'bfloat16'. Uses self.precision if not provided.
+        batch_size : int (optional), default = 10000
+            Number of rows processed at once.
+        out : numpy array (float) (optional)
+            Preallocated array for the output (rows x classes).
+
+        Returns
+        -------
+        output : numpy array (float)
+            Log-probabilities (rows x classes).
+        """
+
+        out = np.empty((len(data),self.num_classes), dtype=np.float32) if out is None else out
+        for i,output in self.forward_chunks(data, batch_size, precision):
+            out[i:i+len(output)] = output.float().cpu().numpy()
+        return out
+
+    def predict_proba(self, data, batch_size=10000, out=None):
+        """Predict Probabilities
+        ========
+
+        Probabilities of each class from the trained neural network, e.g., for soft voting (see log_proba).
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features, which can be memory mapped.
+        batch_size : int (optional), default = 10000
+            Number of rows processed at once.
+        out : numpy array (float) (optional)
+            Preallocated array for the output (rows x classes).
+
+        Returns
+        -------
+        proba : numpy array (float)
+            Probabilities (rows x classes).
+        """
+
+        out = self.log_proba(data, batch_size=batch_size, out=out)
+        return np.exp(out, out=out)
+
+    def predict_blocks(self, blocks, batch_size=10000, log_proba=False):
+        """Predict Blocks
+        ========
+
+        Predicts an iterator of blocks of data, one block at a time, for scoring data that does 
+        not fit in memory.
+        
+        Parameters
+        ----------
+        blocks : iterator
+            Blocks of features (numpy arrays).
+        batch_size : int (optional), default = 10000
+            Number of rows processed at once.
+        log_proba : bool (optional), default = False
+            Whether to return log-probabilities instead of labels.
+
+        Returns
+        -------
+        output : generator
+            Labels (or log-probabilities) of each block.
+        """
+
+        for block in blocks:
+            yield self.log_proba(block, batch_size=batch_size) if log_proba else self.predict(block, batch_size)
+
+    def forward_chunks(self, data, batch_size=10000, precision=None):
+        """Forward Chunks
+        ========
+
+        Applies the trained network to consecutive chunks of the data, on the device the network is on.
+        The chunks are converted to float32 in one reused buffer.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features, which can be memory mapped.
+        batch_size : int (optional), default = 10000
+            Number of rows processed at once.
+        precision : string (optional)
+            Either 'float32' or 'bfloat16'. Uses self.precision if not provided.
+
+        Returns
+        -------
+        chunks : generator
+            Start row and log-probabilities (torch tensor) of each chunk.
+        """
+
+        #Quantized networks have no parameters, and run on the CPU
+        device = next(self.parameters(), torch.zeros(0)).device
+        self.eval()
+
+        buffer = np.empty((min(batch_size,len(data)),) + data.shape[1:], dtype=np.float32)
+        for i in range(0,len(data),batch_size):
+            chunk = buffer[:len(data[i:i+batch_size])]
+            np.copyto(chunk, data[i:i+batch_size], casting='unsafe')
+            with torch.no_grad(), self.autocast(device, precision):
+                output = self.forward(torch.from_numpy(chunk).to(device))
+            yield i, output
+
+    def autocast(self, device, precision=None):
+        """Autocast
+        ========
+
+        Autocast context for the precision of the network.
+        
+        Parameters
+        ----------
+        device : torch device
+            Device the network runs on.
+        precision : string (optional)
+            Either 'float32' or 'bfloat16'. Uses self.precision if not provided.
+
+        Returns
+        -------
+        context : torch.autocast
+            Context manager, which does nothing for float32.
+        """
+
+        if precision is None:
+            precision = self.precision
+        if precision not in ['float32','bfloat16']:
+            raise ValueError("precision must be 'float32' or 'bfloat16'")
+        return torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == 'bfloat16')
+
+    def quantize(self):
+        """Quantize
+        ========
+
+        Post-training dynamic int8 quantization of the linear layers, for fast prediction on the CPU.
+        The weights are stored as int8 and the activations are quantized on the fly.
+
+        Returns
+        -------
+        net : Net
+            Quantized copy of the trained network. It can only be used for prediction, on the CPU.
+        """
+
+        net = Net(**{**self.get_params(), 'precision':'float32'})
+        net.load_state_dict(self.state_dict())
+        net.to(torch.device("cpu"))
+        net.eval()
+        return torch.ao.quantization.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def parity_check(self, data, target=None):
+        """Parity Check
+        ========
+
+        Compares the predictions of the bfloat16 and int8 quantized versions of the trained network 
+        to the float32 network on the same data, e.g., the test data of a split.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features
+        target : numpy array (int) (optional)
+            Labels. If provided the accuracies are also compared.
+
+        Returns
+        -------
+        parity : python dictionary
+            For 'bfloat16' and 'int8', the fraction of rows with the same predicted label as float32 ('Agreement'),
+            the largest difference in log-probabilities ('Max Diff'), and the change in accuracy ('Accuracy Diff').
+            The float32 accuracy is in 'Accuracy'.
+        """
+
+        reference = self.log_proba(data, 'float32')
+        outputs = {'bfloat16':self.log_proba(data, 'bfloat16'), 'int8':self.quantize().log_proba(data)}
+
+        parity = {}
+        if target is not None:
+            parity['Accuracy'] = np.mean(np.argmax(reference, axis=1) == target)
+        for name,output in outputs.items():
+            parity[name] = {'Agreement':np.mean(np.argmax(output, axis=1) == np.argmax(reference, axis=1)),
+                            'Max Diff':np.max(np.abs(output - reference))}
+            if target is not None:
+                parity[name]['Accuracy Diff'] = np.mean(np.argmax(output, axis=1) == target) - parity['Accuracy']
+        return parity
+
+class NetEnsemble(nn.Module):
+    def __init__(self, num_replicas=10, structure=[10,10], num_classes=2, dropout_rate=0.0, epochs=100,
+                 cuda=False, learning_rate=0.1, batch_size=32, gamma=0.9, shuffle=False, verbose=False):
+        """Neural Network Ensemble
+        ========
+
+        Trains many independent copies (replicas) of the Net classifier at once. The weights of all replicas 
+        are stacked, and every layer is a single batched matrix multiplication over the replicas, so a whole
+        replicate study (one replica per train/test split) costs one large fit instead of many small ones.
+        Each replica has its own training rows, mini-batches, dropout masks and optimizer state, and a 
+        replica is not updated once its rows run out in an epoch, so without dropout or shuffling every 
+        replica ends up with the weights of a Net trained from the same initial weights on its rows alone. 
+        Batch normalization is not supported.
+        
+        Parameters
+        ----------
+        num_replicas : int (optional), default = 10
+            Number of replicas.
+        structure : list (optional)
+            List giving number of inputs to each layer (see Net).
+        num_classes : int (optional)
+            Number of classes.
+        dropout_rate : float (optional), default=0
+            Dropout rate.
+        epochs : int (optional), default=100
+            Number of training epochs (loops over whole dataset).
+        cuda : bool (optional), default=False
+            Whether to use GPU, if found.
+        learning_rate : float (optional), default = 0.1
+            Learning rate for training.
+        batch_size : int (optional), default = 32
+            Size of mini-batches for stochastic gradient descent.
+        gamma : float (optional), default = 0.9
+            Scheduler parameter. How much to decrease learning rate at each iteration.
+        shuffle : bool (optional), default = False
+            Whether each replica visits its training data in a new random order every epoch.
+        verbose : bool (optional), default = False
+            Whether to print out details during training or not.
+        """
+
+        super(NetEnsemble, self).__init__()
+
+        self.num_replicas = num_replicas
+        self.structure = structure
+        self.num_classes = num_classes
+        self.dropout_rate = dropout_rate
+        self.epochs = epochs
+        self.cuda = cuda
+        self.learning_rate = learning_rate
+        self.batch_size = batch_size
+        self.gamma = gamma
+        self.shuffle = shuffle
+        self.verbose = verbose
+
+        #Stacked weights (replicas x inputs x outputs) and biases (replicas x outputs) of every layer
+        sizes = list(structure) + [num_classes]
+        self.weights = nn.ParameterList([nn.Parameter(torch.empty(num_replicas,sizes[i],sizes[i+1])) for i in range(len(sizes)-1)])
+        self.biases = nn.ParameterList([nn.Parameter(torch.empty(num_replicas,sizes[i+1])) for i in range(len(sizes)-1)])
+        self.dropout = nn.Dropout(dropout_rate)
+        self.mean, self.scale = None, None
+        self.reset()
+
+    def reset(self):
+
+        #Same initialization as nn.Linear
+        with torch.no_grad():
+            for w,b in zip(self.weights,self.biases):
+                bound = 1/np.sqrt(w.shape[1])
+                w.uniform_(-bound,bound)
+                b.uniform_(-bound,bound)
+
+    def forward(self, x):
+        """Forward
+        ========
+
+        Applies every replica to its own mini-batch.
+        
+        Parameters
+        ----------
+        x : torch tensor (float)
+            Inputs of each replica (replicas x batch size x features). 
+
+        Returns
+        -------
+        output : torch tensor (float)
+            Log-probabilities of each class (replicas x batch size x classes).
+        """
+
+        #Standardization of each replica (see fit)
+        if self.mean is not None:
+            x = (x - self.mean[:,None,:])/self.scale[:,None,:]
+
+        num_layers = len(self.weights)
+        for i,(w,b) in enumerate(zip(self.weights,self.biases)):
+            if self.dropout_rate > 0:
+                x = self.dropout(x)
+            x = torch.baddbmm(b[:,None,:], x, w)
+            if i < num_layers-1:
+                x = F.relu(x)
+        return F.log_softmax(x, dim=2)
+
+    def fit(self, data, target, masks, mean=None, scale=None):
+        """Fit
+        ========
+
+        Trains all replicas, each on its own subset of the rows. The features can be standardized
+        separately for each replica, e.g., with a scaler fit on its training rows, and the same
+        standardization is applied in predict.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features, shared by all replicas.
+        target : numpy array (int)
+            Labels.
+        masks : numpy array (bool)
+            Training rows of each replica (replicas x rows), e.g., the complement of the test masks 
+            from split_indices with num_splits=num_replicas.
+        mean : numpy array (float) (optional)
+            Mean subtracted from the features of each replica (replicas x features). No standardization if not provided.
+        scale : numpy array (float) (optional)
+            Scale the centered features of each replica are divided by (replicas x features).
+        """
+
+        self.reset()
+        masks = np.asarray(masks, dtype=bool)
+        if masks.shape != (self.num_replicas, len(data)):
+            raise ValueError('masks must have shape (num_replicas, number of rows)')
+
+        use_cuda = self.cuda and torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
+        self.to(device)
+
+        data = torch.tensor(np.asarray(data), dtype=torch.float32, device=device)
+        target = torch.tensor(np.asarray(target), dtype=torch.long, device=device)
+        self.mean, self.scale = None, None
+        if mean is not None:
+            self.mean = torch.tensor(np.asarray(mean), dtype=torch.float32, device=device)
+            self.scale = torch.tensor(np.asarray(scale), dtype=torch.float32, device=device)
+
+        #Training rows of each replica, padded to the same length (num_rows holds the true lengths)
+        counts = masks.sum(axis=1)
+        if np.any(counts == 0):
+            raise ValueError('every replica needs at least one training row')
+        rows = np.zeros((self.num_replicas, counts.max()), dtype=int)
+        for r in range(self.num_replicas):
+            rows[r,:counts[r]] = np.flatnonzero(masks[r])
+        rows = torch.as_tensor(rows, device=device)
+        num_rows = torch.as_tensor(counts, device=device)
+        positions = torch.arange(rows.shape[1], device=device)
+
+        optimizer = optim.Adadelta(self.parameters(), lr=self.learning_rate)
+        scheduler = StepLR(optimizer, step_size=1, gamma=self.gamma)
+
+        self.train()
+        for epoch in range(1, self.epochs + 1):
+            order = rows
+            if self.shuffle:
+                #Random keys, with the padding sorted to the end
+                keys = torch.rand(rows.shape, device=device) + (positions >= num_rows[:,None])
+                order = torch.gather(rows, 1, torch.argsort(keys, dim=1))
+
+            total_loss = 0
+            for idx in range(0, rows.shape[1], self.batch_size):
+                batch = order[:,idx:idx+self.batch_size]
+                valid = (positions[idx:idx+self.batch_size] < num_rows[:,None]).float()
+
+                optimizer.zero_grad()
+                output = self.forward(data[batch])
+                loss = -torch.gather(output, 2, target[batch][:,:,None])[:,:,0]
+
+                #Mean loss over the batch of each replica, summed over replicas
+                loss = torch.sum(torch.sum(loss*valid, dim=1)/torch.clamp(valid.sum(dim=1),min=1))
+                loss.backward()
+
+                #Replicas that ran out of rows skip the step, so their weights and optimizer state
+                #match a Net trained on their rows alone (the first batch always has rows, so the state exists)
+                idle = valid.sum(dim=1) == 0
+                if idle.any():
+                    saved = [(p, p.detach()[idle].clone(), {k: v[idle].clone() for k,v in optimizer.state[p].items() if v.dim() > 0})
+                             for p in self.parameters()]
+                optimizer.step()
+                if idle.any():
+                    with torch.no_grad():
+                        for p,values,state in saved:
+                            p[idle] = values
+                            for k,v in state.items():
+                                optimizer.state[p][k][idle] = v
+                total_loss += loss.item()
+            scheduler.step()
+
+            if self.verbose:
+                print('Epoch: %d, Mean Loss: %f'%(epoch, total_loss/self.num_replicas))
+
+    def predict_log_proba(self, data, batch_size=1000):
+        """Predict Log Probabilities
+        ========
+
+        Log-probabilities of each class from every replica. The rows are processed in chunks, 
+        so memory use is bounded for large networks and many replicas.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features.
+        batch_size : int (optional), default = 1000
+            Number of rows processed at a time.
+
+        Returns
+        -------
+        output : numpy array (float)
+            Log-probabilities (replicas x rows x classes).
+        """
+
+        device = self.weights[0].device
+        data = torch.tensor(np.asarray(data), dtype=torch.float32, device=device)
         self.eval()
+        output = np.zeros((self.num_replicas, len(data), self.num_classes), dtype=np.float32)
         with torch.no_grad():
-            pred = torch.argmax(self.forward(data), dim=1)
-        labels = pred.numpy().astype(int)
-        return labels
+            for idx in range(0, len(data), batch_size):
+                chunk = data[idx:idx+batch_size]
+                output[:,idx:idx+batch_size] = self.forward(chunk.expand(self.num_replicas, -1, -1)).cpu().numpy()
+        return output
+
+    def predict(self, data, batch_size=1000):
+        """Predict
+        ========
+
+        Predict labels using every trained replica.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features.
+        batch_size : int (optional), default = 1000
+            Number of rows processed at a time.
+
+        Returns
+        -------
+        labels : numpy array (int)
+            Predicted labels (replicas x rows).
+        """
+
+        return np.argmax(self.predict_log_proba(data, batch_size), axis=2).astype(int)
+
+    def replica(self, r):
+        """Replica
+        ========
+
+        Copies the weights of one replica into a standalone Net. The Net takes standardized features
+        if the replica was fit with a mean and scale.
+        
+        Parameters
+        ----------
+        r : int
+            Index of the replica.
+
+        Returns
+        -------
+        net : Net
+            Trained neural network.
+        """
+
+        net = Net(structure=self.structure, num_classes=self.num_classes, dropout_rate=self.dropout_rate, epochs=self.epochs,
+                  cuda=self.cuda, learning_rate=self.learning_rate, batch_size=self.batch_size, gamma=self.gamma, shuffle=self.shuffle)
+        layers = list(net.fc) + [net.final]
+        with torch.no_grad():
+            for l,w,b in zip(layers,self.weights,self.biases):
+                l.weight.copy_(w[r].T)
+                l.bias.copy_(b[r])
+        return net
+
+class NeighborIndex:
+    def __init__(self, data, n_neighbors=25, num_candidates=None):
+        """Neighbor Index
+        ========
+
+        K-nearest neighbor classifier for many train/test splits of the same rows. The nearest 
+        num_candidates neighbors of every row, among all rows, are found once. Each split then finds 
+        the n_neighbors nearest training rows of a test row by keeping the candidates that are in the
+        training set, and only runs an exact search for test rows with too few training candidates.
+        Predictions are majority votes, with ties going to the smallest label, as in KNeighborsClassifier.
+        
+        Parameters
+        ----------
+        data : numpy array (float)
+            Features of all rows, usually standardized.
+        n_neighbors : int (optional), default = 25
+            Number of neighbors used for classification.
+        num_candidates : int (optional)
+            Number of neighbors of each row that are stored. Uses 4*n_neighbors if not provided.
+        """
+
+        self.data = np.asarray(data, dtype=float)
+        self.n_neighbors = n_neighbors
+        if num_candidates is None:
+            num_candidates = 4*n_neighbors
+        self.num_candidates = min(num_candidates, len(self.data))
+        self.neighbors = NearestNeighbors(n_neighbors=self.num_candidates).fit(self.data).kneighbors(self.data, return_distance=False)
+
+    def kneighbors(self, train, test):
+        """K-Neighbors
+        ========
+
+        Nearest training rows of each test row.
+        
+        Parameters
+        ----------
+        train : numpy array (int)
+            Indices of the training rows.
+        test : numpy array (int)
+            Indices of the testing rows.
+
+        Returns
+        -------
+        neighbors : numpy array (int)
+            Indices of the n_neighbors nearest training rows of each test row, nearest first (test rows x n_neighbors).
+        """
+
+        k = self.n_neighbors
+        is_train = np.zeros(len(self.data), dtype=bool)
+        is_train[train] = True
+
+        #Keep the first k candidates in the training set
+        candidates = self.neighbors[test]
+        keep = is_train[candidates]
+        keep &= np.cumsum(keep, axis=1) <= k
+        found = np.sum(keep, axis=1) == k
+
+        neighbors = np.empty((len(test),k), dtype=int)
+        neighbors[found] = candidates[found][keep[found]].reshape((-1,k))
+
+        #Exact search for the rest
+        if not np.all(found):
+            train = np.asarray(train)
+            nn = NearestNeighbors(n_neighbors=k).fit(self.data[train])
+            neighbors[~found] = train[nn.kneighbors(self.data[np.asarray(test)[~found]], return_distance=False)]
+
+        return neighbors
+
+    def predict(self, train, test, target):
+        """Predict
+        ========
+
+        Predicts the labels of the testing rows from the labels of the training rows.
+        
+        Parameters
+        ----------
+        train : numpy array (int)
+            Indices of the training rows.
+        test : numpy array (int)
+            Indices of the testing rows.
+        target : numpy array (int)
+            Labels of all rows (only the training rows are used).
+
+        Returns
+        -------
+        labels : numpy array (int)
+            Predicted labels of the testing rows.
+        """
+
+        labels = target[self.kneighbors(train, test)]
+        num_classes = np.max(target)+1
+        rows = np.repeat(np.arange(len(labels)), self.n_neighbors)
+        counts = np.bincount(rows*num_classes + labels.ravel(), minlength=len(labels)*num_classes)
+        return np.argmax(counts.reshape((len(labels),num_classes)), axis=1)
+
+def kernel_matrix(data, kernel='linear', gamma='scale', fname=None):
+    """Kernel Matrix
+    ========
+
+    Kernel (Gram) matrix between all rows of the data, for SVMs with kernel='precomputed'. 
+    Computing it once lets many train/test splits of the same rows be fit on sub-blocks 
+    K[train][:,train] (and predicted on K[test][:,train]) without evaluating the kernel again.
+    
+    Parameters
+    ----------
+    data : numpy array (float)
+        Features, usually standardized.
+    kernel : string (optional), default = 'linear'
+        Either 'linear' or 'rbf'.
+    gamma : float or string (optional), default = 'scale'
+        Parameter of the rbf kernel. 'scale' uses 1/(num_features*data.var()), as in sklearn's SVC.
+    fname : string (optional)
+        If provided, the matrix is saved to this .npy file and returned memory mapped, so it can
+        be shared between processes.
+
+    Returns
+    -------
+    K : numpy array (float)
+        Kernel matrix (rows x rows).
+    """
+
+    data = np.asarray(data, dtype=float)
+    K = data @ data.T
+    if kernel == 'rbf':
+        if gamma == 'scale':
+            gamma = 1/(data.shape[1]*data.var())
+        sq_norms = np.diag(K).copy()
+        K *= 2
+        K -= sq_norms[:,None]
+        K -= sq_norms[None,:]
+        np.minimum(K, 0, out=K)
+        K *= gamma
+        np.exp(K, out=K)
+    elif kernel != 'linear':
+        raise ValueError("kernel must be 'linear' or 'rbf'")
+
+    if fname is not None:
+        np.save(fname, K)
+        K = np.load(fname, mmap_mode='r')
+    return K
+
+def split_indices(specimens, percent_test=0.25, rng=None, num_splits=None, masks=False):
+    """Split Indices
+    ========
+    
+    Splits the rows into training and testing sets by specimen, with the desired percentage of
+    the specimens in the testing set. Specimens are encoded to integer codes once, and the rows
+    of the test specimens are found with a vectorized lookup, so the data is never copied.
+    
+    Parameters
+    ----------
+    specimens : numpy array (string)
+        Specimen name of each row.
+    percent_test : float (optional), default = 0.25
+        The percentage of the specimens that go into the testing set.
+    rng : numpy Generator or int (optional)
+        Random number generator or seed. Uses the global numpy random state if not provided.
+    num_splits : int (optional)
+        Number of splits to draw at once. If provided, a boolean matrix (num_splits x rows)
+        that is True for the test rows of each split is returned.
+    masks : bool (optional), default = False
+        Whether to return boolean masks instead of index arrays for a single split.
+    
+    Returns
+    -------
+    train : numpy array (int or bool)
+        Indices (or mask) of the training rows, in their original order.
+    test : numpy array (int or bool)
+        Indices (or mask) of the testing rows, in their original order.
+    """
+    
+    fragments, codes = np.unique(specimens, return_inverse=True)
+    codes = codes.reshape(-1)
+    test_size = max(1, round(fragments.size * percent_test))
+    if rng is not None:
+        rng = np.random.default_rng(rng)
+    
+    if num_splits is not None:
+        # Random keys for every specimen in every split, the test specimens are the smallest ones
+        keys = np.random.random((num_splits, fragments.size)) if rng is None else rng.random((num_splits, fragments.size))
+        chosen = np.argpartition(keys, test_size-1, axis=1)[:,:test_size]
+        test_groups = np.zeros((num_splits, fragments.size), dtype=bool)
+        np.put_along_axis(test_groups, chosen, True, axis=1)
+        return test_groups[:,codes]
+    
+    # Choose which ones go into our test set
+    choice = np.random.choice if rng is None else rng.choice
+    test_groups = np.zeros(fragments.size, dtype=bool)
+    test_groups[choice(fragments.size, size=test_size, replace=False)] = True
+    test = test_groups[codes]
+    
+    if masks:
+        return ~test, test
+    return np.flatnonzero(~test), np.flatnonzero(test)
 
-def train_test_split(data, target, specimens, percent_test = 0.25):
+def train_test_split(data, target, specimens, percent_test = 0.25, rng=None):
     """Train Test Split
     ========
     
     Converts the data and target arrays into training and testing datasets.
-    Splits on specimen with the desired percentage of them in the testing dataset. 
-    This will fail if the inputs aren't in the same order. 
+    Splits on specimen with the desired percentage of them in the testing dataset
+    (see split_indices). This will fail if the inputs aren't in the same order. 
     
     Parameters
     ----------
@@ -416,8 +1539,10 @@ def train_test_split(data, target, specimens, percent_test = 0.25):
         Targets as integers
     specimens : numpy array (string)
         List of specimen names.
-    percent_test : float (optional), default = 0.1
-        The percentage of the dataset that goes into the training dataset.
+    percent_test : float (optional), default = 0.25
+        The percentage of the specimens that go into the testing dataset.
+    rng : numpy Generator or int (optional)
+        Random number generator or seed. Uses the global numpy random state if not provided.
     
     Returns
     -------
@@ -433,48 +1558,63 @@ def train_test_split(data, target, specimens, percent_test = 0.25):
         Fragment names used for final voting.
     """
     
-    # Create our list of frags
-    fragments = np.unique(specimens)
-    # Choose which ones go into our test set
-    test_size = max(1, round(fragments.size * percent_test))
-    testing_fragments = np.random.choice(fragments,size = test_size, replace=False)
-    
-    # Set up the training and testing datasets    
-    data_train = []
-    target_train = []
-    data_test = []
-    target_test = []
-    frag_test = []
-    
-    # Split the dataset
-    for i, frag in enumerate(specimens):
-        if frag in testing_fragments:
-            data_test.append(data[i])
-            target_test.append(target[i])
-            frag_test.append(frag)
-        else:
-            data_train.append(data[i])
-            target_train.append(target[i])
-    
-    # Swap to numpy arrays
-    data_train = np.array(data_train)
-    target_train = np.array(target_train)
-    data_test = np.array(data_test)
-    target_test = np.array(target_test)
-    frag_test = np.array(frag_test)
+    train, test = split_indices(specimens, percent_test, rng)
+    specimens = np.asarray(specimens)
     
-    # Randomization of the order of the data is just a good practice
+    return data[train], target[train], data[test], target[test], specimens[test]
 
-    # data_train, target_train = shuffle(data_train, target_train)
-    # data_test, target_test, frag_test = shuffle(data_test, target_test, frag_test)
+def majority_vote(codes, pred, num_specimens, num_classes=None, rng=None):
+    """Majority Vote
+    ========
     
-    return data_train, target_train, data_test, target_test, frag_test
+    Majority votes of the predictions within every specimen, for all specimens (and replications)
+    at once with a single bincount over (replication, specimen, class). Ties are broken at random.
+    
+    Parameters
+    ----------
+    codes : numpy array (int)
+        Specimen code (0 to num_specimens-1) of each prediction, either one row of codes shared by all 
+        replications or one row per replication. Entries with negative codes are ignored.
+    pred : numpy array (int)
+        Predicted classes, either 1D or a block with one row per replication (reps x rows).
+        Negative predictions are ignored, which allows padding.
+    num_specimens : int
+        Number of specimens.
+    num_classes : int (optional)
+        Number of classes. Uses the largest prediction plus one if not provided.
+    rng : numpy Generator or int (optional)
+        Random number generator or seed for the tie-breaks. Uses the global numpy random state if not provided.
+    
+    Returns
+    -------
+    guess : numpy array (int)
+        Voted class of each specimen (or reps x num_specimens), -1 for specimens without predictions.
+    """
+    
+    single = np.ndim(pred) == 1
+    codes, pred = np.broadcast_arrays(np.atleast_2d(codes), np.atleast_2d(pred))
+    if num_classes is None:
+        num_classes = max(np.max(pred)+1, 1)
+    reps = pred.shape[0]
+    
+    # Count the votes of every (replication, specimen, class)
+    valid = (codes >= 0) & (pred >= 0)
+    rep = np.broadcast_to(np.arange(reps)[:,None], pred.shape)
+    flat = ((rep*num_specimens + codes)*num_classes + pred)[valid]
+    counts = np.bincount(flat, minlength=reps*num_specimens*num_classes).reshape((reps,num_specimens,num_classes))
+    
+    # Random numbers in [0,1) only change the order of tied counts
+    noise = np.random.random(counts.shape) if rng is None else np.random.default_rng(rng).random(counts.shape)
+    guess = np.argmax(counts + noise, axis=2)
+    guess[counts.sum(axis=2) == 0] = -1
+    
+    return guess[0] if single else guess
 
-def specimen_voting(target_output, target_test, frag_test):
-    """Train Test Split
+def specimen_voting(target_output, target_test, frag_test, rng=None):
+    """Specimen Voting
     ========
     
-    Compares outputted targets to their true labels, and votes within specimens.
+    Compares outputted targets to their true labels, and votes within specimens (see majority_vote).
     
     Parameters
     ----------
@@ -484,6 +1624,8 @@ def specimen_voting(target_output, target_test, frag_test):
         True targets.
     frag_test : numpy array (string)
         List of specimen names.
+    rng : numpy Generator or int (optional)
+        Random number generator or seed for the tie-breaks. Uses the global numpy random state if not provided.
     
     Returns
     -------
@@ -491,24 +1633,20 @@ def specimen_voting(target_output, target_test, frag_test):
         Contains each fragment, its true label, and the guess from voting
     """
     
-    # Populate the dictionary with truth values
+    target_output, target_test, frag_test = np.asarray(target_output), np.asarray(target_test), np.asarray(frag_test)
+    frags, first, codes = np.unique(frag_test, return_index=True, return_inverse=True)
+    codes = codes.reshape(-1)
+    guess = majority_vote(codes, target_output, frags.size, rng=rng)
+    
+    # Votes of each fragment
+    votes = np.split(target_output[np.argsort(codes, kind='stable')], np.cumsum(np.bincount(codes))[:-1])
+    
+    # Populate the dictionary, in order of first appearance, with the truth value of the last row
+    last = len(frag_test) - 1 - np.unique(frag_test[::-1], return_index=True)[1]
     voting = {"frags": {}}
-    for i, frag in enumerate(frag_test):
-        voting["frags"][frag] = {"Truth" : target_test[i], "Votes" : [], "Guess" : None}
-    
-    # Add in the votes
-    for i, output in enumerate(target_output):
-        voting["frags"][frag_test[i]]["Votes"].append(output)
-    
-    # Total and sum accuracy
-    correct = 0
-    for frag in voting["frags"].keys():
-        # This helps shake up the votes in case of ties.
-        vote = np.argmax(np.bincount(voting["frags"][frag]["Votes"]) + 1e-6*np.random.rand(1,1))
-        voting["frags"][frag]["Guess"] = vote
-        if(voting["frags"][frag]["Guess"] == voting["frags"][frag]["Truth"]):
-            correct += 1
-
-    voting["Mean Accuracy"] = correct / len(voting["frags"].keys())
+    for j in np.argsort(first):
+        voting["frags"][frag_test[first[j]]] = {"Truth" : target_test[last[j]], "Votes" : list(votes[j]), "Guess" : guess[j]}
+    
+    voting["Mean Accuracy"] = np.mean(guess == target_test[last])
     
     return voting